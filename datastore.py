@@ -0,0 +1,177 @@
+import json
+import os
+import threading
+import numpy as np
+import pandas as pd
+
+
+
+# Length of one bar, gaps shorter than this are not worth refetching
+BAR_LENGTH = {
+    '1min': pd.Timedelta(minutes = 1),
+    '5min': pd.Timedelta(minutes = 5),
+    '30min': pd.Timedelta(minutes = 30),
+    '60min': pd.Timedelta(minutes = 60),
+    'daily': pd.Timedelta(days = 1)
+}
+
+
+class BarStore(object):
+    # Local OHLCV store laid out as <root>/<ticker>/<interval>/<partition>.npy.
+    # Each partition is a structured array (int64 ns timestamp + one float64 per
+    # column) that is read memory-mapped, one file per day for intraday bars and
+    # per year for daily bars. manifest.json records the column names and the
+    # time ranges already fetched, so only missing ranges go to the data provider.
+    def __init__(self, root):
+        self.root = root
+        self._lock = threading.Lock()
+
+    def read(self, ticker, interval, start = None, end = None, fetch = None):
+        # Return the stored bars between `start` and `end` (inclusive). When
+        # `fetch` is given, fetch(start, end) is first called for every part of
+        # the range not covered yet and must return a frame indexed by time.
+        # start=None means from the first stored bar, end=None means now.
+        start = None if start is None else pd.Timestamp(start)
+        end = pd.Timestamp.now() if end is None else pd.Timestamp(end)
+        if fetch is not None:
+            for gap_start, gap_end in self.missing(ticker, interval, start, end):
+                df = fetch(gap_start, gap_end)
+                self.write(ticker, interval, df, gap_start, gap_end)
+        return self._load(ticker, interval, start, end)
+
+    def missing(self, ticker, interval, start, end):
+        # Sub-ranges of [start, end] that have never been fetched
+        covered = self._manifest(ticker, interval)['covered']
+        tolerance = BAR_LENGTH.get(interval, pd.Timedelta(0)).value
+        if start is None:
+            if not covered:
+                return [(None, end)]
+            start = pd.Timestamp(covered[0][0])
+
+        # A gap of exactly one bar is a new bar, e.g. the end date moved forward a day
+        tolerance = max(tolerance, 1)
+        gaps = []
+        cursor = start.value
+        for lo, hi in covered:
+            if hi < cursor:
+                continue
+            if lo > end.value:
+                break
+            if lo - cursor >= tolerance:
+                gaps.append((pd.Timestamp(cursor), pd.Timestamp(lo)))
+            cursor = max(cursor, hi)
+        if end.value - cursor >= tolerance:
+            gaps.append((pd.Timestamp(cursor), end))
+        return gaps
+
+    def write(self, ticker, interval, df, start = None, end = None):
+        # Merge `df` into its partitions and mark [start, end] as fetched. Bars
+        # are appended, a bar already stored for the same time is replaced.
+        df = df.sort_index()
+        with self._lock:
+            manifest = self._manifest(ticker, interval)
+            # Columns come from the first frame with bars, an empty fetch (e.g. over
+            # a weekend) has object columns and would leave the store without prices
+            if manifest['columns'] is None and len(df) > 0:
+                manifest['columns'] = list(df.select_dtypes(include = [np.number]).columns)
+            dtype = self._dtype(manifest['columns'] or [])
+
+            if len(df) > 0:
+                os.makedirs(self._path(ticker, interval), exist_ok = True)
+                times = df.index.values.astype('M8[ns]')
+                keys = self._partition_keys(times, interval)
+                for key in np.unique(keys):
+                    rows = keys == key
+                    new = np.zeros(rows.sum(), dtype = dtype)
+                    new['t'] = times[rows].view('i8')
+                    for column in manifest['columns']:
+                        if column in df.columns:
+                            new[column] = df[column].values[rows]
+                        else:
+                            new[column] = np.nan
+                    self._merge_partition(ticker, interval, key, new)
+
+            if start is None:
+                start = df.index[0] if len(df) > 0 else end
+            if end is None:
+                end = df.index[-1] if len(df) > 0 else start
+            if start is not None and end is not None:
+                manifest['covered'] = self._add_range(manifest['covered'],
+                                                      pd.Timestamp(start).value, pd.Timestamp(end).value)
+            self._save_json(self._path(ticker, interval, 'manifest.json'), manifest)
+
+    def _load(self, ticker, interval, start, end):
+        manifest = self._manifest(ticker, interval)
+        columns = manifest['columns'] or []
+        folder = self._path(ticker, interval)
+        names = sorted(f for f in os.listdir(folder) if f.endswith('.npy')) if os.path.isdir(folder) else []
+
+        # Only open the partitions that overlap the requested window
+        first = None if start is None else self._partition_keys(np.array([start.value], dtype = 'M8[ns]'), interval)[0]
+        last = self._partition_keys(np.array([end.value], dtype = 'M8[ns]'), interval)[0]
+        parts = []
+        for name in names:
+            key = name[:-len('.npy')]
+            if (first is not None and key < first) or key > last:
+                continue
+            bars = np.load(os.path.join(folder, name), mmap_mode = 'r')
+            lo = 0 if start is None else np.searchsorted(bars['t'], start.value, side = 'left')
+            hi = np.searchsorted(bars['t'], end.value, side = 'right')
+            parts.append(bars[lo:hi])
+        bars = np.concatenate(parts) if parts else np.zeros(0, dtype = self._dtype(columns))
+
+        df = pd.DataFrame({column: bars[column] for column in columns}, columns = columns,
+                          index = pd.DatetimeIndex(bars['t'].view('M8[ns]'), name = 'date'))
+        return df
+
+    def _merge_partition(self, ticker, interval, key, new):
+        path = self._path(ticker, interval, key + '.npy')
+        if os.path.exists(path):
+            old = np.load(path)
+            # Keep the newest copy of each timestamp
+            old = old[~np.isin(old['t'], new['t'])]
+            new = np.concatenate([old, new])
+        new = new[np.argsort(new['t'], kind = 'mergesort')]
+        tmp = path + '.tmp'
+        with open(tmp, 'wb') as f:
+            np.save(f, new)
+        os.replace(tmp, path)
+
+    def _manifest(self, ticker, interval):
+        path = self._path(ticker, interval, 'manifest.json')
+        if not os.path.exists(path):
+            return {'columns': None, 'covered': []}
+        with open(path) as f:
+            return json.load(f)
+
+    def _save_json(self, path, data):
+        os.makedirs(os.path.dirname(path), exist_ok = True)
+        tmp = path + '.tmp'
+        with open(tmp, 'w') as f:
+            json.dump(data, f)
+        os.replace(tmp, path)
+
+    def _path(self, ticker, interval, *names):
+        return os.path.join(self.root, ticker.upper(), interval, *names)
+
+    @staticmethod
+    def _dtype(columns):
+        return np.dtype([('t', 'i8')] + [(column, 'f8') for column in columns])
+
+    @staticmethod
+    def _partition_keys(times, interval):
+        if interval == 'daily':
+            return np.datetime_as_string(times.astype('M8[Y]'))
+        return np.datetime_as_string(times.astype('M8[D]'))
+
+    @staticmethod
+    def _add_range(covered, lo, hi):
+        # Insert [lo, hi] into a sorted list of disjoint ranges, merging overlaps
+        ranges = sorted(covered + [[lo, hi]])
+        merged = [ranges[0]]
+        for lo, hi in ranges[1:]:
+            if lo <= merged[-1][1]:
+                merged[-1][1] = max(merged[-1][1], hi)
+            else:
+                merged.append([lo, hi])
+        return merged
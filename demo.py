@@ -7,21 +7,30 @@ import plotly.graph_objs as go
 
 import base64
 import io
+import os
 import pandas as pd
-import json
 from datetime import datetime
 from dateutil.relativedelta import relativedelta
 import pandas_datareader.data as web
-from alpha_vantage.timeseries import TimeSeries
 
 import lib
+import dataclient
+import datastore
+import optimizer
+import reports
 import strat_macrossover
 import strat_bollingerbands
 
 
-#Get data with package alpha_vantage
+#Get data from Alpha Vantage, one pooled and rate limited client
 lib.init()
-ts = TimeSeries(key = lib.api_key, output_format = 'pandas')
+ts = dataclient.DataClient(lib.api_key)
+#Bars already downloaded are served from the local store
+store = datastore.BarStore(os.path.join(os.path.dirname(os.path.abspath(__file__)), 'data'))
+#Strategy reports are kept server-side, the page only holds their run ID
+report_store = reports.ReportStore()
+#Past optimiser trials per ticker, reruns start from the best of them
+trial_history = optimizer.TrialHistory(os.path.join(os.path.dirname(os.path.abspath(__file__)), 'data', 'trials'))
     
 external_stylesheets = ['https://codepen.io/chriddyp/pen/bWLwgP.css']
 
@@ -253,27 +262,27 @@ def run_strategy(n_clicks, tab, contents, filename, strategy, ticker, start_date
                 '4. close': 'Close',
                 '5. volume': 'Volume'
             }
-            if interval == '1min':
-                df, metadata = ts.get_intraday(ticker, interval = '1min', outputsize = 'full')
-                df.rename(columns = col_dict, inplace = True) #Rename column of data
-            elif interval == '5min':
-                df, metadata = ts.get_intraday(ticker, interval = '5min', outputsize = 'full')
-                df.rename(columns = col_dict, inplace = True)
-            elif interval == '30min':
-                df, metadata = ts.get_intraday(ticker, interval = '30min', outputsize = 'full')
-                df.rename(columns = col_dict, inplace = True)
-            elif interval == '60min':
-                df, metadata = ts.get_intraday(ticker, interval = '60min', outputsize = 'full')
-                df.rename(columns = col_dict, inplace = True)
+            if interval in ('1min', '5min', '30min', '60min'):
+                # Intraday history always comes in full, the store keeps what was already fetched
+                def fetch(start, end):
+                    df, metadata = ts.get_intraday(ticker, interval = interval, outputsize = 'full')
+                    df.rename(columns = col_dict, inplace = True) #Rename column of data
+                    return df
+                df = store.read(ticker, interval, fetch = fetch)
             else:
-                df = web.DataReader(ticker, 'yahoo', start_date, end_date)
+                def fetch(start, end):
+                    return web.DataReader(ticker, 'yahoo', start, end)
+                df = store.read(ticker, interval, start_date, end_date, fetch = fetch)
                 
+        # Uploaded files have no ticker to key the trial history on
+        key_ticker = ticker if tab == 'online' else None
         if strategy == 'macrossover':
-            report_dict = strat_macrossover.run_strat(df, interval)
+            report_dict = strat_macrossover.run_strat(df, interval, ticker = key_ticker, history = trial_history)
         elif strategy == 'bollingerbands':
-            report_dict = strat_bollingerbands.run_strat(df, interval)
+            report_dict = strat_bollingerbands.run_strat(df, interval, ticker = key_ticker, history = trial_history)
         
-    return json.dumps(report_dict)
+    # Only the run ID goes to the browser, the report stays on the server
+    return report_store.put(report_dict) if len(report_dict) > 0 else ''
 
 
 @app.callback(
@@ -287,14 +296,14 @@ def run_strategy(n_clicks, tab, contents, filename, strategy, ticker, start_date
 def update_performance(json_report):
     start_date = (datetime.now() - relativedelta(years = 2)).strftime("%Y-%m-%d")
     end_date = datetime.now().strftime("%Y-%m-%d")
-    report_dict = json.loads(json_report)
+    report_dict = report_store.get(json_report) or {}
     if len(report_dict) > 0:
         commission = report_dict['commission']
         cummulative_return = report_dict['cummulative_return']
         sharpe_ratio = report_dict['sharpe_ratio']
         cagr = report_dict['cagr']
         
-        df = pd.read_json(report_dict['df'], orient = 'split')
+        df = report_dict['df']
         start_date = df.index[0].strftime("%Y-%m-%d")
         end_date = df.index[-1].strftime("%Y-%m-%d")
         return html.Div(
@@ -317,10 +326,10 @@ def update_performance(json_report):
     ]
 )
 def update_stats_info(ticker, json_report):
-    report_dict = json.loads(json_report)
+    report_dict = report_store.get(json_report) or {}
 
     if len(report_dict) > 0:
-        df = pd.read_json(report_dict['df'], orient = 'split')
+        df = report_dict['df']
         stats_df = df.describe(include = 'all')
         stats_df.reset_index(inplace = True)
 
@@ -358,11 +367,11 @@ def update_stats_info(ticker, json_report):
                Input('json_report', 'children')])
 def plot_graph_signals(ticker, json_report):
     figure = {}
-    report_dict = json.loads(json_report)
+    report_dict = report_store.get(json_report) or {}
     
     if len(report_dict) > 0:
-        df = pd.read_json(report_dict['df'], orient = 'split')
-        signals = pd.read_json(report_dict['signals'], orient = 'split')
+        df = report_dict['df']
+        signals = report_dict['signals']
         strategy = report_dict['strategy']
         optimal_paras = report_dict['optimal_paras']
         
@@ -427,11 +436,11 @@ def plot_graph_signals(ticker, json_report):
               [Input('json_report', 'children')])
 def plot_graph_portfolio(json_report):
     figure = {}
-    report_dict = json.loads(json_report)
+    report_dict = report_store.get(json_report) or {}
     
     if len(report_dict) > 0:
-        port_intraday = pd.read_json(report_dict['port_intraday'], orient = 'split')
-        signals = pd.read_json(report_dict['signals'], orient = 'split')
+        port_intraday = report_dict['port_intraday']
+        signals = report_dict['signals']
         
         port_trace = go.Scatter(x = port_intraday.index, y = port_intraday['total'], \
                                      mode = 'lines', name = 'total')
@@ -463,11 +472,11 @@ def plot_graph_portfolio(json_report):
               [Input('json_report', 'children')])
 def plot_graph_drawdown(json_report):
     figure = {}
-    report_dict = json.loads(json_report)
+    report_dict = report_store.get(json_report) or {}
     
     if len(report_dict) > 0:
-        daily_drawdown = pd.read_json(report_dict['daily_drawdown'], orient = 'split')
-        max_daily_drawdown = pd.read_json(report_dict['max_daily_drawdown'], orient = 'split')
+        daily_drawdown = report_dict['daily_drawdown']
+        max_daily_drawdown = report_dict['max_daily_drawdown']
         
         trace1 = go.Scatter(x = daily_drawdown.index, y = daily_drawdown['daily_df'], \
                                      mode = 'lines', fill='tozeroy', name = 'Daily Drawdown')
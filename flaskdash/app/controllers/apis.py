@@ -1,73 +1,144 @@
 # Copyright 2018 Twin Tech Labs. All rights reserved
 
 from flask import Blueprint
-from flask import request, url_for, flash, send_from_directory, jsonify, render_template_string
+from flask import request, url_for, flash, send_from_directory, jsonify, render_template_string, Response
 from flask_user import current_user, login_required, roles_accepted
 
 from app import db
 from app.models.user_models import UserProfileForm
-import uuid, json, os
+import uuid, json, os, time
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
 
-from alpha_vantage.timeseries import TimeSeries
-from app.tradingapp import lib
+# The Dash app's Alpha Vantage client, so both share one quota and connection pool
+from app.tradingapp.services import report_store, ts
+from app.tradingapp.apicache import ResponseCache, to_epoch_ms, parse_tickers, batch_body, MAX_BATCH, BATCH_MAX_WAIT
 
 import yfinance as yf
 from dateutil.relativedelta import relativedelta
 
-lib.init()
-ts = TimeSeries(key = lib.api_key, output_format = 'pandas')
-
 # When using a Flask app factory we must use a blueprint to avoid needing 'app' for '@app.route'
 api_blueprint = Blueprint('api', __name__, template_folder='templates')
 
-@api_blueprint.route('/example', methods=['POST'])
-def sample_page():
+# Chart front-ends poll /ts and /yf, serve repeats from memory until the next bar is due
+response_cache = ResponseCache()
 
-    ret = {"sample return": 10}
-    return(jsonify(ret), 200)
+# Fetches the missing symbols of a /batch request concurrently
+batch_executor = ThreadPoolExecutor(8)
 
-@api_blueprint.route('/ts', methods=['GET'])
-def tsapi():
+col_dict = {
+    '1. open': 'Open',
+    '2. high': 'High',
+    '3. low': 'Low',
+    '4. close': 'Close',
+    '5. volume': 'Volume'
+}
 
-    col_dict = {
-        '1. open': 'Open',
-        '2. high': 'High',
-        '3. low': 'Low',
-        '4. close': 'Close',
-        '5. volume': 'Volume'
-    }
-
-    interval = '1min'
-    ticker = request.args['ticker']
-    df, metadata = ts.get_intraday(symbol=ticker, interval='60min', outputsize='full')
+def fetch_ts(ticker, interval, max_wait=None):
+    df, metadata = ts.get_intraday(symbol=ticker, interval=interval, outputsize='full', max_wait=max_wait)
     df.rename(columns=col_dict, inplace=True)  # Rename column of data
 
     df.reset_index(inplace=True)
 
-    result = df.to_json(orient='values', date_unit='ms')
+    return df
 
-    return result
-
-@api_blueprint.route('/yf', methods=['GET'])
-def yfapi():
-
-    col_dict = {
-        '1. open': 'Open',
-        '2. high': 'High',
-        '3. low': 'Low',
-        '4. close': 'Close',
-        '5. volume': 'Volume'
-    }
-
-
-    ticker = request.args['ticker']
+def fetch_yf(ticker, interval, max_wait=None):
+    # yfinance has no quota to wait for, `max_wait` is only there to match fetch_ts
     start_date = (datetime.now() - relativedelta(days=7)).strftime("%Y-%m-%d")
     end_date = datetime.now().strftime("%Y-%m-%d")
-    df = yf.download(ticker, start=start_date, end=end_date, interval="1m")
+    df = yf.download(ticker, start=start_date, end=end_date, interval=interval)
 
     df.rename(columns=col_dict, inplace=True)  # Rename column of data
 
     df.reset_index(inplace=True)
 
-    return df.to_json(orient='values', date_unit='ms')
+    return df
+
+# Fetch function, bar interval and the intervals the upstream offers, per endpoint
+sources = {
+    'ts': (fetch_ts, '60min', ('1min', '5min', '15min', '30min', '60min')),
+    'yf': (fetch_yf, '1m', ('1m', '2m', '5m', '15m', '30m', '60m', '90m', '1h'))
+}
+
+def get_series(source, ticker, interval=None, max_wait=None):
+    fetch, default_interval, _ = sources[source]
+    interval = interval or default_interval
+    return response_cache.get((source, ticker, interval), interval, lambda: fetch(ticker, interval, max_wait))
+
+def get_batch(source, tickers, interval):
+    # {ticker: cached series, or the exception its fetch raised}. Symbols share the
+    # cache entries of /ts and /yf, only the missing ones reach the upstream.
+    def get(ticker):
+        try:
+            return get_series(source, ticker, interval, BATCH_MAX_WAIT)
+        except Exception as e:
+            return e
+    return dict(zip(tickers, batch_executor.map(get, tickers)))
+
+def series_response(source):
+    # The whole series as JSON rows (304 if the client already holds this ETag), or
+    # with since=<epoch ms or date time> only the bars after that time
+    try:
+        since = to_epoch_ms(request.args['since']) if 'since' in request.args else None
+    except ValueError:
+        return (jsonify({'error': 'since must be epoch milliseconds or a date time'}), 400)
+
+    entry = get_series(source, request.args['ticker'].upper())
+    if since is not None:
+        response = Response(entry.since(since), mimetype='application/json')
+    else:
+        response = Response(entry.body, mimetype='application/json')
+        response.set_etag(entry.etag)
+    response.cache_control.max_age = max(int(entry.expires - time.time()), 0)
+    return response.make_conditional(request)
+
+@api_blueprint.route('/example', methods=['POST'])
+def sample_page():
+
+    ret = {"sample return": 10}
+    return(jsonify(ret), 200)
+
+# /ts/stream and /yf/stream (Server-Sent Events) are only served by the asyncio app in
+# async_apis.py, an open stream would hold one of the few sync workers for good
+@api_blueprint.route('/ts', methods=['GET'])
+def tsapi():
+
+    return series_response('ts')
+
+@api_blueprint.route('/yf', methods=['GET'])
+def yfapi():
+
+    return series_response('yf')
+
+@api_blueprint.route('/batch', methods=['GET'])
+def batchapi():
+
+    # Many tickers in one columnar response, e.g. /batch?source=yf&tickers=AAPL,MSFT&interval=5m.
+    # Symbols the rate limit can't serve in time are reported in 'errors' as RateLimitError.
+    source = request.args.get('source', 'ts')
+    if source not in sources:
+        return (jsonify({'error': 'source must be one of ' + ', '.join(sources)}), 400)
+    tickers = parse_tickers(request.args.get('tickers', ''))
+    interval = request.args.get('interval', sources[source][1])
+    if interval not in sources[source][2] or not 0 < len(tickers) <= MAX_BATCH:
+        return (jsonify({'error': 'expected an interval of {} and 1 to {} tickers'.format(
+            ', '.join(sources[source][2]), MAX_BATCH)}), 400)
+
+    entries = get_batch(source, tickers, interval)
+    body, etag = batch_body(source, interval, entries)
+    response = Response(body, mimetype='application/json')
+    response.set_etag(etag)
+    expires = [entry.expires for entry in entries.values() if not isinstance(entry, Exception)]
+    response.cache_control.max_age = max(int(min(expires) - time.time()), 0) if expires else 0
+    return response.make_conditional(request)
+
+@api_blueprint.route('/report/<run_id>', methods=['GET'])
+@login_required  # Reports belong to the Dash app, which requires a login too
+def reportapi(run_id):
+
+    # Binary columnar strategy report, see app.tradingapp.reports for the layout
+    payload = report_store.payload(run_id)
+    if payload is None:
+        return (jsonify({'error': 'unknown run id'}), 404)
+
+    return Response(payload, mimetype='application/octet-stream')
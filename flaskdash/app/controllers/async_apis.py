@@ -0,0 +1,170 @@
+import asyncio
+import json
+import time
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import parse_qs
+
+from app.tradingapp.apicache import AsyncResponseCache, to_epoch_ms, parse_tickers, batch_body, MAX_BATCH, BATCH_MAX_WAIT
+
+# asyncio server for the market data endpoints of apis.py: /ts, /yf, their /stream
+# variants and /batch are served on the event loop, so an open poll or SSE connection
+# costs a coroutine instead of a server thread. Upstream fetches are blocking client
+# calls, they run in a thread pool with a bound on concurrent fetches per upstream.
+# It runs as its own process beside the gunicorn Flask app (see asgi.py and
+# runserver.sh) and answers 404 for every other path. The Flask pages load it
+# from another origin (settings.MARKET_DATA_URL), hence the CORS headers.
+
+# Concurrent fetches per upstream, Alpha Vantage is limited by its quota anyway
+upstream_limits = {'ts': 4, 'yf': 8}
+
+since_error = b'{"error": "since must be epoch milliseconds or a date time"}'
+
+class MarketDataApp(object):
+
+    def __init__(self, sources, limits=upstream_limits, max_workers=16, keep_alive=15.0, allow_origin='*'):
+        # `sources` maps the endpoint name to (fetch(ticker, interval, max_wait) -> DataFrame,
+        # default interval, intervals offered), see apis.sources. `allow_origin` is the
+        # Access-Control-Allow-Origin of every response, the series carry no user data.
+        self.sources = sources
+        self.cors = [(b'access-control-allow-origin', allow_origin.encode('latin-1')),
+                     (b'access-control-expose-headers', b'etag')]
+        self.keep_alive = keep_alive
+        self.executor = ThreadPoolExecutor(max_workers)
+        self.cache = AsyncResponseCache(self.executor, limits)
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] == 'lifespan':
+            return await self.lifespan(receive, send)
+        if scope['type'] == 'http' and scope['method'] == 'OPTIONS':
+            # CORS preflight, for a conditional GET or an EventSource resuming
+            return await self.respond(send, 204, b'', [(b'access-control-allow-methods', b'GET, HEAD'),
+                                                      (b'access-control-allow-headers', b'if-none-match, last-event-id'),
+                                                      (b'access-control-max-age', b'86400')])
+        if scope['type'] == 'http' and scope['method'] in ('GET', 'HEAD'):
+            source, _, stream = scope['path'].strip('/').partition('/')
+            query = {k: v[-1] for k, v in parse_qs(scope['query_string'].decode('latin-1'), keep_blank_values=True).items()}
+            headers = {k.decode('latin-1').lower(): v.decode('latin-1') for k, v in scope['headers']}
+            if source == 'batch' and not stream:
+                return await self.batch_response(query, headers, send, scope['method'] == 'HEAD')
+            if source in self.sources and stream in ('', 'stream'):
+                if 'ticker' not in query:
+                    return await self.respond(send, 400, b'{"error": "missing ticker"}')
+                if stream:
+                    return await self.series_stream(source, query, headers, receive, send)
+                return await self.series_response(source, query, headers, send, scope['method'] == 'HEAD')
+        if scope['type'] == 'http':
+            await self.respond(send, 404, b'{"error": "not found"}')
+
+    async def lifespan(self, receive, send):
+        while True:
+            message = await receive()
+            if message['type'] == 'lifespan.startup':
+                await send({'type': 'lifespan.startup.complete'})
+            elif message['type'] == 'lifespan.shutdown':
+                self.executor.shutdown(wait=False)
+                await send({'type': 'lifespan.shutdown.complete'})
+                return
+
+    def get_series(self, source, ticker, interval=None, max_wait=None):
+        fetch, default_interval, _ = self.sources[source]
+        interval = interval or default_interval
+        return self.cache.get((source, ticker, interval), interval, lambda: fetch(ticker, interval, max_wait), source)
+
+    async def series_response(self, source, query, headers, send, head=False):
+        # Same responses as apis.series_response: the whole series with its ETag (304
+        # if the client holds it already), or with since= only the bars after that time
+        try:
+            since = to_epoch_ms(query['since']) if 'since' in query else None
+        except ValueError:
+            return await self.respond(send, 400, since_error)
+
+        entry = await self.get_series(source, query['ticker'].upper())
+        extra = [(b'cache-control', 'max-age={}'.format(max(int(entry.expires - time.time()), 0)).encode())]
+        if since is not None:
+            body = entry.since(since)
+        else:
+            etag = '"{}"'.format(entry.etag)
+            extra.append((b'etag', etag.encode()))
+            if self.not_modified(headers, etag):
+                return await self.respond(send, 304, b'', extra)
+            body = entry.body
+        await self.respond(send, 200, b'' if head else body, extra, len(body))
+
+    async def batch_response(self, query, headers, send, head=False):
+        # Same responses as apis.batchapi, the missing symbols are fetched concurrently
+        source = query.get('source', 'ts')
+        if source not in self.sources:
+            error = {'error': 'source must be one of ' + ', '.join(self.sources)}
+            return await self.respond(send, 400, json.dumps(error).encode())
+        tickers = parse_tickers(query.get('tickers', ''))
+        interval = query.get('interval', self.sources[source][1])
+        if interval not in self.sources[source][2] or not 0 < len(tickers) <= MAX_BATCH:
+            error = {'error': 'expected an interval of {} and 1 to {} tickers'.format(
+                ', '.join(self.sources[source][2]), MAX_BATCH)}
+            return await self.respond(send, 400, json.dumps(error).encode())
+
+        results = await asyncio.gather(*[self.get_series(source, ticker, interval, BATCH_MAX_WAIT)
+                                         for ticker in tickers], return_exceptions=True)
+        entries = dict(zip(tickers, results))
+        body, etag = batch_body(source, interval, entries)
+        expires = [entry.expires for entry in results if not isinstance(entry, BaseException)]
+        etag = '"{}"'.format(etag)
+        extra = [(b'cache-control', 'max-age={}'.format(max(int(min(expires) - time.time()), 0) if expires else 0).encode()),
+                 (b'etag', etag.encode())]
+        if self.not_modified(headers, etag):
+            return await self.respond(send, 304, b'', extra)
+        await self.respond(send, 200, b'' if head else body, extra, len(body))
+
+    async def series_stream(self, source, query, headers, receive, send):
+        # Server-Sent Events: the series (or the bars after since=), then every new
+        # bar as it comes into the cache. Event IDs are the last bar's epoch ms, so a
+        # reconnecting EventSource resumes through Last-Event-ID.
+        ticker = query['ticker'].upper()
+        since = headers.get('last-event-id', query.get('since'))
+        try:
+            last = to_epoch_ms(since) if since else None
+        except ValueError:
+            return await self.respond(send, 400, since_error)
+
+        disconnected = asyncio.Event()
+
+        async def listen():
+            while (await receive())['type'] != 'http.disconnect':
+                pass
+            disconnected.set()
+
+        listener = asyncio.ensure_future(listen())
+        await send({'type': 'http.response.start', 'status': 200,
+                    'headers': [(b'content-type', b'text/event-stream'), (b'cache-control', b'no-cache'),
+                                (b'x-accel-buffering', b'no')] + self.cors})
+        try:
+            while not disconnected.is_set():
+                entry = await self.get_series(source, ticker)
+                if entry.last is not None and (last is None or entry.last > last):
+                    body = entry.body if last is None else entry.since(last)
+                    last = entry.last
+                    await self.send_body(send, 'id: {}\ndata: {}\n\n'.format(last, body.decode('utf-8')).encode('utf-8'))
+                # Nothing new before the next bar, keep the connection open meanwhile
+                while time.time() < entry.expires and not disconnected.is_set():
+                    try:
+                        await asyncio.wait_for(disconnected.wait(), min(self.keep_alive, max(entry.expires - time.time(), 0.0)))
+                    except asyncio.TimeoutError:
+                        await self.send_body(send, b': keep-alive\n\n')
+        finally:
+            listener.cancel()
+        await send({'type': 'http.response.body', 'body': b''})
+
+    @staticmethod
+    def not_modified(headers, etag):
+        matches = [tag.strip() for tag in headers.get('if-none-match', '').split(',')]
+        return etag in matches or 'W/' + etag in matches or '*' in matches
+
+    @staticmethod
+    async def send_body(send, body):
+        await send({'type': 'http.response.body', 'body': body, 'more_body': True})
+
+    async def respond(self, send, status, body, headers=[], length=None):
+        headers = [(b'content-type', b'application/json'),
+                   (b'content-length', str(len(body) if length is None else length).encode())] + self.cors + headers
+        await send({'type': 'http.response.start', 'status': status, 'headers': headers})
+        await send({'type': 'http.response.body', 'body': body})
@@ -26,4 +26,8 @@ USER_REQUIRE_RETYPE_PASSWORD = True  # Prompt for `retype password` in:
 USER_ENABLE_USERNAME = False  # Register and Login with username
 USER_AFTER_LOGIN_ENDPOINT = 'main.member_page'
 USER_AFTER_LOGOUT_ENDPOINT = 'main.member_page'
-USER_ALLOW_LOGIN_WITHOUT_CONFIRMED_EMAIL = False
\ No newline at end of file
+USER_ALLOW_LOGIN_WITHOUT_CONFIRMED_EMAIL = False
+
+# Market data service (asgi.py) the pages load /ts, /yf, /batch and the streams
+# from, e.g. 'https://data.example.com'. Empty for port 5001 of the page's host.
+MARKET_DATA_URL = os.environ.get('MARKET_DATA_URL', '')
\ No newline at end of file
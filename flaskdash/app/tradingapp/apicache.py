@@ -0,0 +1,234 @@
+import asyncio
+import hashlib
+import json
+import logging
+import threading
+import time
+from collections import OrderedDict
+import numpy as np
+import pandas as pd
+
+
+
+logger = logging.getLogger(__name__)
+
+# Length of one bar in seconds, for the interval names of both data providers
+BAR_SECONDS = {
+    '1m': 60, '1min': 60,
+    '2m': 120,
+    '5m': 300, '5min': 300,
+    '15m': 900, '15min': 900,
+    '30m': 1800, '30min': 1800,
+    '60m': 3600, '60min': 3600, '1h': 3600,
+    '90m': 5400,
+    '1d': 86400, 'daily': 86400
+}
+
+# Most tickers one /batch request may ask for
+MAX_BATCH = 100
+# Longest a /batch symbol waits for the upstream's rate limit. Symbols the quota
+# can't serve by then are reported as errors, a later poll picks them up.
+BATCH_MAX_WAIT = 5.0
+# The providers publish a bar some time after its boundary. A refetch that brings
+# no newer bar is tried again after this many seconds, doubled on every further
+# miss until that reaches the bar's length.
+RETRY_SECONDS = 15
+
+def to_epoch_ms(value):
+    # Epoch milliseconds, as `to_json(date_unit='ms')` writes them, from a
+    # number of milliseconds or anything pd.Timestamp reads (naive means UTC).
+    # Raises ValueError for anything else, the endpoints answer that with a 400.
+    value = str(value)
+    if value.lstrip('-').isdigit():
+        return int(value)
+    stamp = pd.Timestamp(value)
+    if stamp is pd.NaT:
+        raise ValueError('not a time: {!r}'.format(value))
+    if stamp.tz is not None:
+        stamp = stamp.tz_convert('UTC').tz_localize(None)
+    return stamp.value // 10 ** 6
+
+
+def parse_tickers(value):
+    # Upper-cased tickers of a comma separated list, duplicates dropped, in order
+    return list(dict.fromkeys(t.strip().upper() for t in value.split(',') if t.strip()))
+
+
+def batch_body(source, interval, entries):
+    # One JSON document for many tickers from {ticker: CachedResponse or the
+    # exception its fetch raised}: {"source", "interval", "symbols": {ticker:
+    # {column: [values]}}, "errors": {ticker: exception name}}. Returns (body, etag).
+    symbols = b','.join(json.dumps(ticker).encode('utf-8') + b':' + entry.columnar
+                        for ticker, entry in entries.items() if isinstance(entry, CachedResponse))
+    # Only the exception type goes to the client, messages of the HTTP client's
+    # exceptions contain the request URL with the API key
+    errors = {}
+    for ticker, entry in entries.items():
+        if not isinstance(entry, CachedResponse):
+            logger.warning('%s %s %s fetch failed: %r', source, ticker, interval, entry)
+            errors[ticker] = type(entry).__name__
+    body = '{{"source": {}, "interval": {}, "symbols": {{'.format(json.dumps(source), json.dumps(interval)).encode('utf-8') \
+        + symbols + '}}, "errors": {}}}'.format(json.dumps(errors)).encode('utf-8')
+    return body, hashlib.sha1(body).hexdigest()
+
+
+class CachedResponse(object):
+    # A fetched series: the frame (bar time in the first column), its full JSON
+    # body with the SHA-1 ETag, and when it has to be fetched again
+    def __init__(self, frame, expires):
+        self.frame = frame
+        self.expires = expires
+        # Seconds this entry waits for a bar the provider hadn't published, 0 if none
+        self.retry = 0
+        self.body = frame.to_json(orient = 'values', date_unit = 'ms').encode('utf-8')
+        self.etag = hashlib.sha1(self.body).hexdigest()
+        times = frame.iloc[:, 0] if len(frame.columns) > 0 else pd.Series([], dtype = 'M8[ns]')
+        self.times = pd.DatetimeIndex(times).asi8 // 10 ** 6
+        self._columnar = None
+
+    @property
+    def last(self):
+        # Time of the newest bar in epoch ms, None for an empty series
+        return int(self.times.max()) if len(self.times) > 0 else None
+
+    @property
+    def columnar(self):
+        # The series as a JSON object of {column: [values]}, for /batch. Built on
+        # first use and kept, a watchlist asks for the same tickers every poll.
+        if self._columnar is None:
+            self._columnar = b'{' + b','.join(json.dumps(str(name)).encode('utf-8') + b':'
+                                              + self.frame.iloc[:, k].to_json(orient = 'values', date_unit = 'ms').encode('utf-8')
+                                              for k, name in enumerate(self.frame.columns)) + b'}'
+        return self._columnar
+
+    def since(self, ms):
+        # JSON rows of the bars after `ms`, in the order of the full body
+        rows = np.flatnonzero(self.times > ms)
+        return self.frame.iloc[rows].to_json(orient = 'values', date_unit = 'ms').encode('utf-8')
+
+
+class _Fetch(object):
+    # A computation in flight that later requests for the same key wait on
+    def __init__(self):
+        self.done = threading.Event()
+        self.entry = None
+        self.error = None
+
+
+class ResponseCache(object):
+    # Fetched API series keyed by e.g. (endpoint, ticker, interval). An
+    # entry lives until the next bar of its interval is due, or RETRY_SECONDS
+    # when its refetch didn't bring that bar yet. Concurrent misses on
+    # the same key wait for a single computation instead of each calling the
+    # data provider. The body's SHA-1 is kept as the ETag for conditional GETs.
+    def __init__(self, max_items = 256):
+        self.max_items = max_items
+        self._entries = OrderedDict()
+        self._pending = {}
+        self._lock = threading.Lock()
+
+    def get(self, key, interval, compute):
+        # The cached series for `key`, fetched with compute() -> DataFrame when missing or expired
+        now = time.time()
+        with self._lock:
+            previous = self._entries.get(key)
+            if previous is not None and previous.expires > now:
+                self._entries.move_to_end(key)
+                return previous
+            call = self._pending.get(key)
+            owner = call is None
+            if owner:
+                call = self._pending[key] = _Fetch()
+
+        if not owner:
+            # A failed fetch fails its waiters too, instead of each retrying upstream
+            call.done.wait()
+            if call.error is not None:
+                raise call.error
+            return call.entry
+
+        try:
+            call.entry = CachedResponse(compute(), self.expiry(interval, now))
+            self.retry_stale(call.entry, previous, interval, now)
+            with self._lock:
+                self._entries[key] = call.entry
+                self._entries.move_to_end(key)
+                while len(self._entries) > self.max_items:
+                    self._entries.popitem(last = False)
+        except Exception as e:
+            call.error = e
+            raise
+        finally:
+            with self._lock:
+                del self._pending[key]
+            call.done.set()
+        return call.entry
+
+    @staticmethod
+    def expiry(interval, now):
+        # Expire at the next bar boundary, so a poll right after it sees the new bar
+        seconds = BAR_SECONDS.get(interval, 60)
+        return (now // seconds + 1) * seconds
+
+    @staticmethod
+    def retry_stale(entry, previous, interval, now):
+        # A refetch whose newest bar is no newer than the expired entry's came
+        # before the provider published the bar, try again after entry.retry seconds
+        if previous is None or (entry.last is not None and (previous.last is None or entry.last > previous.last)):
+            return
+        retry = previous.retry * 2 if previous.retry else RETRY_SECONDS
+        if retry < BAR_SECONDS.get(interval, 60):
+            entry.expires = now + retry
+            entry.retry = retry
+
+
+class AsyncResponseCache(object):
+    # asyncio counterpart of ResponseCache for the ASGI endpoints. A miss runs the
+    # blocking compute() in `executor`, with at most limits[upstream] (default 4)
+    # fetches running per upstream, and concurrent misses on a key share one
+    # fetch. Only use it from the event loop's thread.
+    def __init__(self, executor = None, limits = None, max_items = 256):
+        self.executor = executor
+        self.limits = limits or {}
+        self.max_items = max_items
+        self._entries = OrderedDict()
+        self._pending = {}
+        self._semaphores = {}
+
+    async def get(self, key, interval, compute, upstream = None):
+        entry = self._entries.get(key)
+        if entry is not None and entry.expires > time.time():
+            self._entries.move_to_end(key)
+            return entry
+        future = self._pending.get(key)
+        if future is None:
+            future = self._pending[key] = asyncio.ensure_future(self._fetch(key, interval, compute, upstream, entry))
+        # A client going away must not cancel the fetch the others wait for
+        return await asyncio.shield(future)
+
+    async def _fetch(self, key, interval, compute, upstream, previous):
+        loop = asyncio.get_event_loop()
+        try:
+            async with self._semaphore(upstream):
+                # Serializing is CPU work too, keep it off the event loop
+                entry = await loop.run_in_executor(self.executor, self._compute, interval, compute, previous)
+            self._entries[key] = entry
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_items:
+                self._entries.popitem(last = False)
+            return entry
+        finally:
+            del self._pending[key]
+
+    @staticmethod
+    def _compute(interval, compute, previous):
+        now = time.time()
+        entry = CachedResponse(compute(), ResponseCache.expiry(interval, now))
+        ResponseCache.retry_stale(entry, previous, interval, now)
+        return entry
+
+    def _semaphore(self, upstream):
+        # Created on first use so that it belongs to the running loop
+        if upstream not in self._semaphores:
+            self._semaphores[upstream] = asyncio.Semaphore(self.limits.get(upstream, 4))
+        return self._semaphores[upstream]
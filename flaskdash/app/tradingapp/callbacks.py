@@ -1,3 +1,4 @@
+import dash
 import dash_table as dt
 import dash_core_components as dcc
 import dash_html_components as html
@@ -6,15 +7,16 @@ import plotly.graph_objs as go
 
 import base64
 import io
+import os
 import pandas as pd
-import json
 from datetime import datetime
 from dateutil.relativedelta import relativedelta
 import pandas_datareader.data as web
-from alpha_vantage.timeseries import TimeSeries
 
-from app.tradingapp import lib
+from app.tradingapp import datastore
+from app.tradingapp import jobs
 from app.tradingapp import strat_macrossover
+from app.tradingapp.services import ts, report_store
 
 from flask import session
 import logging
@@ -23,9 +25,10 @@ import logging
 
 logger = logging.getLogger(__name__)
 
-#Get data with package alpha_vantage
-lib.init()
-ts = TimeSeries(key = lib.api_key, output_format = 'pandas')
+#Bars already downloaded are served from the local store
+store = datastore.BarStore(os.path.join(os.path.dirname(os.path.abspath(__file__)), 'data'))
+#Strategy searches run in background processes, the page polls their status
+job_queue = jobs.JobQueue(os.path.join(os.path.dirname(os.path.abspath(__file__)), 'data', 'jobs.sqlite'))
 
 layout_graph = go.Layout({
     'xaxis': {
@@ -44,6 +47,14 @@ layout_graph = go.Layout({
     }
 })
 
+def strategy_job(progress, df, strategy, interval):
+    #Runs in a job queue process, returns the run ID of the stored report
+    report_dict = {}
+    if strategy == 'macrossover':
+        report_dict = strat_macrossover.run_strat(df, interval, progress = progress)
+    return report_store.put(report_dict) if len(report_dict) > 0 else ''
+
+
 def register_callbacks(dashapp):
     @dashapp.callback(
         Output('button_run', 'disabled'),
@@ -105,7 +116,7 @@ def register_callbacks(dashapp):
     
         
     @dashapp.callback(
-        Output('json_report', 'children'),
+        Output('job_id', 'children'),
         [Input('button_run', 'n_clicks')],
         [
             State('tabs_data', 'value'),
@@ -119,8 +130,6 @@ def register_callbacks(dashapp):
         ]
     )
     def run_strategy(n_clicks, tab, contents, filename, strategy, ticker, start_date, end_date, interval):
-        report_dict = {}
-    
         if n_clicks:
             if tab == 'local':
                 #Read data
@@ -142,25 +151,63 @@ def register_callbacks(dashapp):
                     '4. close': 'Close',
                     '5. volume': 'Volume'
                 }
-                if interval == '1min':
-                    df, metadata = ts.get_intraday(ticker, interval = '1min', outputsize = 'full')
-                    df.rename(columns = col_dict, inplace = True) #Rename column of data
-                elif interval == '5min':
-                    df, metadata = ts.get_intraday(ticker, interval = '5min', outputsize = 'full')
-                    df.rename(columns = col_dict, inplace = True)
-                elif interval == '30min':
-                    df, metadata = ts.get_intraday(ticker, interval = '30min', outputsize = 'full')
-                    df.rename(columns = col_dict, inplace = True)
-                elif interval == '60min':
-                    df, metadata = ts.get_intraday(ticker, interval = '60min', outputsize = 'full')
-                    df.rename(columns = col_dict, inplace = True)
+                if interval in ('1min', '5min', '30min', '60min'):
+                    # Intraday history always comes in full, the store keeps what was already fetched
+                    def fetch(start, end):
+                        df, metadata = ts.get_intraday(ticker, interval = interval, outputsize = 'full')
+                        df.rename(columns = col_dict, inplace = True) #Rename column of data
+                        return df
+                    df = store.read(ticker, interval, fetch = fetch)
                 else:
-                    df = web.DataReader(ticker, 'yahoo', start_date, end_date)
+                    def fetch(start, end):
+                        return web.DataReader(ticker, 'yahoo', start, end)
+                    df = store.read(ticker, interval, start_date, end_date, fetch = fetch)
                     
-            if strategy == 'macrossover':
-                report_dict = strat_macrossover.run_strat(df, interval)
-            
-        return json.dumps(report_dict)
+            # The search itself runs in the background, the page polls 'job_poll'
+            return job_queue.submit(strategy_job, df, strategy, interval)
+        
+        return ''
+    
+    
+    @dashapp.callback(
+        [
+            Output('json_report', 'children'),
+            Output('job_status', 'children'),
+            Output('job_poll', 'disabled')
+        ],
+        [
+            Input('job_poll', 'n_intervals'),
+            Input('job_id', 'children')
+        ]
+    )
+    def poll_job(n_intervals, job_id):
+        if not job_id:
+            return dash.no_update, None, True
+        
+        job = job_queue.status(job_id)
+        if job is None:
+            return dash.no_update, 'Job not found.', True
+        if job['status'] in ('queued', 'running', 'cancelling'):
+            return dash.no_update, 'Running strategy: {:.0%}'.format(job['progress'] or 0), False
+        if job['status'] == 'done':
+            # Only the run ID goes to the browser, the report stays on the server
+            return job['result'], None, True
+        if job['status'] == 'failed':
+            logger.error('Strategy job %s failed:\n%s', job_id, job['error'])
+            return dash.no_update, 'Strategy run failed.', True
+        return dash.no_update, 'Strategy run cancelled.', True
+    
+    
+    @dashapp.callback(
+        Output('job_cancelled', 'children'),
+        [Input('button_cancel', 'n_clicks')],
+        [State('job_id', 'children')]
+    )
+    def cancel_job(n_clicks, job_id):
+        if n_clicks and job_id:
+            job_queue.cancel(job_id)
+            return job_id
+        return None
     
     
     @dashapp.callback(
@@ -174,14 +221,14 @@ def register_callbacks(dashapp):
     def update_performance(json_report):
         start_date = (datetime.now() - relativedelta(years = 2)).strftime("%Y-%m-%d")
         end_date = datetime.now().strftime("%Y-%m-%d")
-        report_dict = json.loads(json_report)
+        report_dict = report_store.get(json_report) or {}
         if len(report_dict) > 0:
             commission = report_dict['commission']
             cummulative_return = report_dict['cummulative_return']
             sharpe_ratio = report_dict['sharpe_ratio']
             cagr = report_dict['cagr']
             
-            df = pd.read_json(report_dict['df'], orient = 'split')
+            df = report_dict['df']
             start_date = df.index[0].strftime("%Y-%m-%d")
             end_date = df.index[-1].strftime("%Y-%m-%d")
             return html.Div(
@@ -204,10 +251,10 @@ def register_callbacks(dashapp):
         ]
     )
     def update_stats_info(ticker, json_report):
-        report_dict = json.loads(json_report)
+        report_dict = report_store.get(json_report) or {}
     
         if len(report_dict) > 0:
-            df = pd.read_json(report_dict['df'], orient = 'split')
+            df = report_dict['df']
             stats_df = df.describe(include = 'all')
             stats_df.reset_index(inplace = True)
     
@@ -245,11 +292,11 @@ def register_callbacks(dashapp):
                    Input('json_report', 'children')])
     def plot_graph_signals(ticker, json_report):
         figure = {}
-        report_dict = json.loads(json_report)
+        report_dict = report_store.get(json_report) or {}
         
         if len(report_dict) > 0:
-            df = pd.read_json(report_dict['df'], orient = 'split')
-            signals = pd.read_json(report_dict['signals'], orient = 'split')
+            df = report_dict['df']
+            signals = report_dict['signals']
             optimal_paras = report_dict['optimal_paras']
             
             price = go.Scatter(x = df.index, y = df['Open'], mode = 'lines', name = ticker)
@@ -287,11 +334,11 @@ def register_callbacks(dashapp):
                   [Input('json_report', 'children')])
     def plot_graph_portfolio(json_report):
         figure = {}
-        report_dict = json.loads(json_report)
+        report_dict = report_store.get(json_report) or {}
         
         if len(report_dict) > 0:
-            port_intraday = pd.read_json(report_dict['port_intraday'], orient = 'split')
-            signals = pd.read_json(report_dict['signals'], orient = 'split')
+            port_intraday = report_dict['port_intraday']
+            signals = report_dict['signals']
             
             port_trace = go.Scatter(x = port_intraday.index, y = port_intraday['total'], \
                                          mode = 'lines', name = 'total')
@@ -323,11 +370,11 @@ def register_callbacks(dashapp):
                   [Input('json_report', 'children')])
     def plot_graph_drawdown(json_report):
         figure = {}
-        report_dict = json.loads(json_report)
+        report_dict = report_store.get(json_report) or {}
         
         if len(report_dict) > 0:
-            daily_drawdown = pd.read_json(report_dict['daily_drawdown'], orient = 'split')
-            max_daily_drawdown = pd.read_json(report_dict['max_daily_drawdown'], orient = 'split')
+            daily_drawdown = report_dict['daily_drawdown']
+            max_daily_drawdown = report_dict['max_daily_drawdown']
             
             trace1 = go.Scatter(x = daily_drawdown.index, y = daily_drawdown['daily_df'], \
                                          mode = 'lines', fill='tozeroy', name = 'Daily Drawdown')
@@ -0,0 +1,155 @@
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+import pandas as pd
+import requests
+from requests.adapters import HTTPAdapter
+
+
+
+ALPHA_VANTAGE_URL = 'https://www.alphavantage.co/query'
+
+
+class RateLimitError(ValueError):
+    pass
+
+
+class TokenBucket(object):
+    # Allows `rate` calls per `per` seconds with bursts of up to `capacity` calls.
+    # The bucket is per process: with several server workers give each one its
+    # share of the provider's quota.
+    def __init__(self, rate, per = 60.0, capacity = None):
+        self.rate = float(rate) / per
+        # At least one call, a worker's share of the quota can be below 1 per minute
+        self.capacity = float(capacity if capacity is not None else max(rate, 1))
+        self._tokens = self.capacity
+        self._stamp = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self, timeout = None):
+        # Block until a call is allowed. With a `timeout` in seconds, raise
+        # RateLimitError right away when no call will be allowed by then.
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self._tokens = min(self.capacity, self._tokens + (now - self._stamp) * self.rate)
+                self._stamp = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                wait = (1 - self._tokens) / self.rate
+            if deadline is not None and now + wait > deadline:
+                raise RateLimitError('rate limit allows no call within {} s'.format(timeout))
+            time.sleep(wait)
+
+
+class _Call(object):
+    # A request in flight that later callers for the same key wait on
+    def __init__(self, max_wait):
+        self.max_wait = max_wait
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class DataClient(object):
+    # Shared Alpha Vantage client: one pooled HTTP session, a token bucket for
+    # the per-minute quota, and duplicate requests coalesced while in flight, so
+    # concurrent callers asking for the same (ticker, interval) cause one call.
+    # `get_intraday` returns (df, meta_data) like alpha_vantage's TimeSeries
+    # with output_format='pandas'. `base_url` can point to a local stub server.
+    # With `max_wait` (seconds) a call raises RateLimitError instead of waiting
+    # longer than that for the rate limit. A caller joining a request in flight
+    # gets that request's result, except that callers without `max_wait` fetch
+    # again when only the other caller's `max_wait` made it fail.
+    def __init__(self, api_key, base_url = ALPHA_VANTAGE_URL, calls_per_minute = 5, \
+                 pool_size = 4, timeout = 30, retries = 2):
+        self.api_key = api_key
+        self.base_url = base_url
+        self.timeout = timeout
+        self.retries = retries
+        self.bucket = TokenBucket(calls_per_minute, 60.0)
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections = pool_size, pool_maxsize = pool_size)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+        self._executor = ThreadPoolExecutor(pool_size)
+        self._calls = {}
+        self._lock = threading.Lock()
+
+    def get_intraday(self, symbol, interval = '15min', outputsize = 'compact', max_wait = None):
+        params = {'function': 'TIME_SERIES_INTRADAY', 'symbol': symbol.upper(),
+                  'interval': interval, 'outputsize': outputsize}
+        return self._single_flight(params, 'Time Series ({})'.format(interval), max_wait)
+
+    def get_daily(self, symbol, outputsize = 'compact', max_wait = None):
+        params = {'function': 'TIME_SERIES_DAILY', 'symbol': symbol.upper(), 'outputsize': outputsize}
+        return self._single_flight(params, 'Time Series (Daily)', max_wait)
+
+    def prefetch(self, symbols, interval = '60min', outputsize = 'full'):
+        # Fetch many tickers concurrently within the rate limit. Returns
+        # {symbol: (df, meta_data)}, or the exception for symbols that failed.
+        futures = {symbol: self._executor.submit(self.get_intraday, symbol, interval, outputsize)
+                   for symbol in symbols}
+        results = {}
+        for symbol, future in futures.items():
+            try:
+                results[symbol] = future.result()
+            except Exception as e:
+                results[symbol] = e
+        return results
+
+    def _single_flight(self, params, key, max_wait = None):
+        call_key = tuple(sorted(params.items()))
+        with self._lock:
+            call = self._calls.get(call_key)
+            owner = call is None
+            if owner:
+                call = self._calls[call_key] = _Call(max_wait)
+
+        if owner:
+            try:
+                call.result = self._fetch(params, key, max_wait)
+            except Exception as e:
+                call.error = e
+            finally:
+                with self._lock:
+                    del self._calls[call_key]
+                call.done.set()
+        else:
+            call.done.wait()
+            if isinstance(call.error, RateLimitError) and call.max_wait is not None and max_wait is None:
+                return self._single_flight(params, key)
+
+        if call.error is not None:
+            raise call.error
+        df, meta_data = call.result
+        # Every caller gets its own frame, callers rename columns in place
+        return df.copy(), dict(meta_data)
+
+    def _fetch(self, params, key, max_wait = None):
+        params = dict(params, apikey = self.api_key, datatype = 'json')
+        deadline = None if max_wait is None else time.monotonic() + max_wait
+        for attempt in range(self.retries + 1):
+            self.bucket.acquire(None if deadline is None else max(deadline - time.monotonic(), 0.0))
+            response = self.session.get(self.base_url, params = params, timeout = self.timeout)
+            response.raise_for_status()
+            data = response.json()
+            if 'Error Message' in data:
+                raise ValueError(data['Error Message'])
+            if 'Note' in data or 'Information' in data:
+                # Quota message, another process used the key: back off one token and retry
+                backoff = 1.0 / self.bucket.rate
+                if attempt == self.retries or (deadline is not None and time.monotonic() + backoff > deadline):
+                    raise RateLimitError(data.get('Note') or data.get('Information'))
+                time.sleep(backoff)
+                continue
+            return self._frame(data[key]), data['Meta Data']
+
+    @staticmethod
+    def _frame(series):
+        df = pd.DataFrame.from_dict(series, orient = 'index', dtype = float)
+        df.index = pd.to_datetime(df.index)
+        df.index.name = 'date'
+        return df.sort_index(ascending = False)
@@ -0,0 +1,125 @@
+import multiprocessing as mp
+import os
+import sqlite3
+import threading
+import time
+import traceback
+import uuid
+from concurrent.futures import ProcessPoolExecutor
+
+
+
+class JobCancelled(Exception):
+    pass
+
+
+def _connect(db_path):
+    conn = sqlite3.connect(db_path, timeout = 30, isolation_level = None)
+    conn.row_factory = sqlite3.Row
+    return conn
+
+
+def _run(db_path, job_id, fn, args):
+    # Executed in a pool process: runs fn(progress, *args) and records the outcome
+    conn = _connect(db_path)
+
+    def update(**fields):
+        fields['updated'] = time.time()
+        columns = ', '.join('%s = ?' % k for k in fields)
+        conn.execute('UPDATE jobs SET %s WHERE id = ?' % columns, list(fields.values()) + [job_id])
+
+    def progress(done, total, message = None):
+        # Called by the task after each step, raises once the job is cancelled
+        row = conn.execute('SELECT status FROM jobs WHERE id = ?', (job_id,)).fetchone()
+        if row['status'] == 'cancelling':
+            raise JobCancelled()
+        update(progress = float(done) / total, message = message)
+
+    try:
+        row = conn.execute('SELECT status FROM jobs WHERE id = ?', (job_id,)).fetchone()
+        if row is None or row['status'] != 'queued':
+            if row is not None and row['status'] == 'cancelling':
+                update(status = 'cancelled')
+            return
+        update(status = 'running', pid = os.getpid())
+        result = fn(progress, *args)
+        update(status = 'done', progress = 1.0, result = result)
+    except JobCancelled:
+        update(status = 'cancelled')
+    except Exception:
+        update(status = 'failed', error = traceback.format_exc())
+    finally:
+        conn.close()
+
+
+class JobQueue(object):
+    # Background runner for long strategy jobs, so Dash callbacks return at once.
+    # Jobs run in a local process pool. Their state lives in a SQLite table, so
+    # any gunicorn worker can poll or cancel a job, whichever worker started it.
+    # A task is a picklable function fn(progress, *args) returning a short string
+    # (e.g. a report run ID); it should call progress(done, total) regularly,
+    # which is also where a cancelled job stops.
+    def __init__(self, db_path, max_workers = 2, max_age = 24 * 3600):
+        self.db_path = db_path
+        self.max_workers = max_workers
+        self.max_age = max_age
+        self._executor = None
+        self._lock = threading.Lock()
+        os.makedirs(os.path.dirname(os.path.abspath(db_path)), exist_ok = True)
+        conn = _connect(db_path)
+        conn.execute('PRAGMA journal_mode = WAL')
+        conn.execute('''CREATE TABLE IF NOT EXISTS jobs (
+                            id TEXT PRIMARY KEY, status TEXT, progress REAL, message TEXT,
+                            result TEXT, error TEXT, pid INTEGER, created REAL, updated REAL)''')
+        conn.close()
+
+    def submit(self, fn, *args):
+        job_id = uuid.uuid4().hex
+        now = time.time()
+        conn = _connect(self.db_path)
+        conn.execute('DELETE FROM jobs WHERE updated < ?', (now - self.max_age,))
+        # Until a pool process takes the job, its pid is the submitting process's:
+        # the pool goes down with it, and the job would otherwise stay queued
+        conn.execute('INSERT INTO jobs (id, status, progress, pid, created, updated) VALUES (?, ?, ?, ?, ?, ?)',
+                     (job_id, 'queued', 0.0, os.getpid(), now, now))
+        conn.close()
+        self._pool().submit(_run, self.db_path, job_id, fn, args)
+        return job_id
+
+    def status(self, job_id):
+        # Dict of the job row, or None for an unknown job
+        conn = _connect(self.db_path)
+        row = conn.execute('SELECT * FROM jobs WHERE id = ?', (job_id,)).fetchone()
+        if row is not None and row['status'] in ('queued', 'running', 'cancelling') and not self._alive(row['pid']):
+            # The pool process, or the worker the job was queued in, exited (e.g.
+            # gunicorn --max-requests)
+            conn.execute("UPDATE jobs SET status = 'failed', error = ?, updated = ? WHERE id = ?",
+                         ('worker process exited', time.time(), job_id))
+            row = conn.execute('SELECT * FROM jobs WHERE id = ?', (job_id,)).fetchone()
+        conn.close()
+        return dict(row) if row is not None else None
+
+    def cancel(self, job_id):
+        conn = _connect(self.db_path)
+        conn.execute("UPDATE jobs SET status = 'cancelling', updated = ? "
+                     "WHERE id = ? AND status IN ('queued', 'running')", (time.time(), job_id))
+        conn.close()
+
+    def _pool(self):
+        with self._lock:
+            if self._executor is None:
+                # Spawn rather than fork, the web server process is multi-threaded
+                self._executor = ProcessPoolExecutor(self.max_workers, mp_context = mp.get_context('spawn'))
+            return self._executor
+
+    @staticmethod
+    def _alive(pid):
+        if pid is None:
+            return True
+        try:
+            os.kill(pid, 0)
+        except ProcessLookupError:
+            return False
+        except PermissionError:
+            pass
+        return True
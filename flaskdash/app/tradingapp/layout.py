@@ -94,6 +94,10 @@ layout = html.Div(
         ),
         html.Br(),
         html.Button('Run Strategy', id = 'button_run'),
+        html.Button('Cancel', id = 'button_cancel', style = {'marginLeft': 10}),
+        html.Div(id = 'job_status'),
+        # Polls the background job started by 'Run Strategy' until it finishes
+        dcc.Interval(id = 'job_poll', interval = 1000, disabled = True),
         html.Div(id = 'output_performance'),
         html.Div(id = 'stats_info'),
 
@@ -103,6 +107,8 @@ layout = html.Div(
 
         # Hidden div inside the app that stores the intermediate value
         html.Div(id = 'json_report', style = {'display': 'none'}),
+        html.Div(id = 'job_id', style = {'display': 'none'}),
+        html.Div(id = 'job_cancelled', style = {'display': 'none'}),
                           
     ], style = {'textAlign': 'center'}
 )
@@ -4,6 +4,8 @@ import numpy as np
 import pandas as pd
 style.use('ggplot')
 
+from app.tradingapp import metrics
+
 
 
 def init():
@@ -111,33 +113,28 @@ def annualised_sharpe(returns, window = 252):
         return 0.0
         
     
-def backtesting(portfolio, window = 252):
+def backtesting(portfolio, window = 252, shares = None, prices = None):
     df_close = portfolio['daily_df']
     # Calculate the max drawdown in the past window days for eachs day 
-    rolling_max = df_close.rolling(window, min_periods=1).max()
-    daily_drawdown = df_close/rolling_max - 1.0
+    rolling_max = metrics.rolling_max(df_close.values, window)
+    with np.errstate(invalid = 'ignore', divide = 'ignore'):
+        daily_drawdown = df_close.values / rolling_max - 1.0
     # Calculate the minimum (negative) daily drawdown
-    max_daily_drawdown = daily_drawdown.rolling(window, min_periods=1).min()
-    
-    returns = portfolio['returns']
-    # Compute cummulative return
-    print('Cummulative return: {:.2%}'.format(returns.cumsum()[-1]))
-    # Compute annualized Sharpe ratio
-    sharpe_ratio = annualised_sharpe(returns)
-    print('Annualized Sharpe ratio: %.2f' % (sharpe_ratio))
+    max_daily_drawdown = metrics.rolling_min(daily_drawdown, window)
     
-    # Get the number of days in data
-    days = (df_close.index[-1] - df_close.index[0]).days
-    # Calculate the CAGR 
-    cagr = ((((df_close[-1]) / df_close[1])) ** (365.0/days)) - 1
-    print('CAGR: {:.2%}'.format(cagr))
+    # Performance of the strategy's portfolio value, turnover needs the
+    # position in `shares` and the `prices` traded at (bar by bar)
+    days = (portfolio.index[-1] - portfolio.index[0]).days
+    result = metrics.compute(portfolio['total'].values, portfolio['returns'].values, days, \
+                             shares, prices, window)
     
     backtest_data = {
-                     'daily_drawdown': pd.DataFrame(daily_drawdown),
-                     'max_daily_drawdown': pd.DataFrame(max_daily_drawdown),
-                     'cummulative_return': returns.cumsum()[-1],
-                     'sharpe_ratio': sharpe_ratio,
-                     'cagr': cagr
+                     'daily_drawdown': pd.DataFrame({'daily_df': daily_drawdown}, index = df_close.index),
+                     'max_daily_drawdown': pd.DataFrame({'daily_df': max_daily_drawdown}, index = df_close.index),
+                     'cummulative_return': result.cummulative_return,
+                     'sharpe_ratio': result.sharpe_ratio,
+                     'cagr': result.cagr,
+                     'metrics': result
                      }
     return backtest_data
 
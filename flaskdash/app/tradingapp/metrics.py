@@ -0,0 +1,107 @@
+from collections import namedtuple
+import numpy as np
+
+
+
+# Performance summary of one equity curve, or of a batch of curves when every
+# field is an array with one value per curve
+Metrics = namedtuple('Metrics', ['cummulative_return', 'cagr', 'sharpe_ratio', 'sortino_ratio',
+                                 'max_drawdown', 'max_drawdown_duration', 'calmar_ratio', 'turnover'])
+
+
+# All functions below work along the last axis, so a (n_curves, n_bars)
+# matrix of equity curves or returns is evaluated in one call.
+
+def rolling_max(values, window):
+    # Max over the last `window` values (min_periods=1, NaN skipped) in O(n):
+    # prefix and suffix maxima of window-sized blocks (van Herk / Gil-Werman)
+    values = np.asarray(values, dtype = float)
+    n = values.shape[-1]
+    if n == 0:
+        return values.copy()
+    window = min(int(window), n)
+    pad = -n % window
+    padded = np.concatenate([values, np.full(values.shape[:-1] + (pad,), np.nan)], axis = -1)
+    blocks = padded.reshape(values.shape[:-1] + (-1, window))
+    prefix = np.fmax.accumulate(blocks, axis = -1).reshape(padded.shape)[..., :n]
+    suffix = np.fmax.accumulate(blocks[..., ::-1], axis = -1)[..., ::-1].reshape(padded.shape)[..., :n]
+
+    # The window ending at i starts at i - window + 1: its max is the suffix max
+    # from there to the end of that block joined with the prefix max up to i
+    result = prefix.copy()
+    result[..., window - 1:] = np.fmax(suffix[..., :n - window + 1], prefix[..., window - 1:])
+    return result
+
+
+def rolling_min(values, window):
+    return -rolling_max(-np.asarray(values, dtype = float), window)
+
+
+def drawdown(equity):
+    # Relative distance below the running peak, 0 at every new high
+    equity = np.asarray(equity, dtype = float)
+    with np.errstate(invalid = 'ignore', divide = 'ignore'):
+        return equity / np.fmax.accumulate(equity, axis = -1) - 1.0
+
+
+def max_drawdown(equity):
+    return np.nanmin(drawdown(equity), axis = -1)
+
+
+def max_drawdown_duration(equity):
+    # Longest number of bars spent below a previous peak
+    below = drawdown(equity) < 0
+    bars = np.arange(below.shape[-1])
+    # Position of the last bar at a peak, carried forward
+    last_peak = np.maximum.accumulate(np.where(below, 0, bars), axis = -1)
+    return (bars - last_peak).max(axis = -1)
+
+
+def sharpe_ratio(returns, window = 252):
+    returns = np.asarray(returns, dtype = float)
+    with np.errstate(invalid = 'ignore', divide = 'ignore'):
+        return np.sqrt(window) * np.nanmean(returns, axis = -1) / np.nanstd(returns, axis = -1, ddof = 1)
+
+
+def sortino_ratio(returns, window = 252):
+    # Like the Sharpe ratio but only losses count as risk
+    returns = np.asarray(returns, dtype = float)
+    downside = np.sqrt(np.nanmean(np.minimum(returns, 0.0) ** 2, axis = -1))
+    with np.errstate(invalid = 'ignore', divide = 'ignore'):
+        return np.sqrt(window) * np.nanmean(returns, axis = -1) / downside
+
+
+def cagr(equity, days):
+    # Compound annual growth from the first to the last value over `days` calendar days
+    equity = np.asarray(equity, dtype = float)
+    with np.errstate(invalid = 'ignore', divide = 'ignore'):
+        return (equity[..., -1] / equity[..., 0]) ** (365.0 / days) - 1
+
+
+def turnover(shares, prices, equity, days):
+    # Traded value per year as a multiple of the average equity
+    shares = np.asarray(shares, dtype = float)
+    traded = np.abs(np.diff(shares, axis = -1, prepend = 0.0)) * np.asarray(prices, dtype = float)
+    with np.errstate(invalid = 'ignore', divide = 'ignore'):
+        return np.nansum(traded, axis = -1) / np.nanmean(equity, axis = -1) * 365.0 / days
+
+
+def compute(equity, returns, days, shares = None, prices = None, window = 252):
+    # All metrics of `equity` (portfolio value) and its per-period `returns`
+    # over `days` calendar days. Turnover needs the position in `shares` and
+    # the `prices` it was traded at, it is NaN without them.
+    equity = np.asarray(equity, dtype = float)
+    growth = cagr(equity, days)
+    drawdowns = max_drawdown(equity)
+    with np.errstate(invalid = 'ignore', divide = 'ignore'):
+        calmar = growth / np.abs(drawdowns)
+    return Metrics(
+        cummulative_return = equity[..., -1] / equity[..., 0] - 1,
+        cagr = growth,
+        sharpe_ratio = sharpe_ratio(returns, window),
+        sortino_ratio = sortino_ratio(returns, window),
+        max_drawdown = drawdowns,
+        max_drawdown_duration = max_drawdown_duration(equity),
+        calmar_ratio = calmar,
+        turnover = turnover(shares, prices, equity, days) if shares is not None else np.nan * growth
+    )
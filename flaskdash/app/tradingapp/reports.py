@@ -0,0 +1,242 @@
+import hashlib
+import json
+import os
+import struct
+import threading
+import time
+import uuid
+from collections import OrderedDict
+import numpy as np
+import pandas as pd
+
+
+
+# Binary report layout, little-endian:
+#   b'QTRP' | uint32 header size | JSON header | padding to 8 bytes | data buffers
+# The header holds the plain values of the report and, for every DataFrame, the
+# dtype, offset (from the start of the data) and length of its index and of
+# each column. Buffers are 8-byte aligned so they can be mapped with np.frombuffer.
+MAGIC = b'QTRP'
+VERSION = 1
+
+
+def _padding(n):
+    return -n % 8
+
+
+def _plain(value):
+    # NumPy scalars in the report values to JSON types
+    if isinstance(value, np.generic):
+        return value.item()
+    raise TypeError('%r is not JSON serializable' % (value,))
+
+
+def encode_report(report):
+    # Binary columnar encoding of a `run_strat` report
+    header = {'version': VERSION, 'values': {}, 'frames': {}}
+    buffers = []
+    size = [0]
+    
+    def add(values):
+        data = np.ascontiguousarray(values).tobytes()
+        spec = {'dtype': values.dtype.str, 'offset': size[0], 'length': len(values)}
+        buffers.append(data + b'\0' * _padding(len(data)))
+        size[0] += len(data) + _padding(len(data))
+        return spec
+    
+    for key, value in report.items():
+        if not isinstance(value, pd.DataFrame):
+            header['values'][key] = value
+            continue
+        index = value.index
+        if isinstance(index, pd.DatetimeIndex):
+            # Stored as UTC nanoseconds plus the time zone name
+            spec = add(index.asi8.view('M8[ns]'))
+            spec['tz'] = str(index.tz) if index.tz is not None else None
+        else:
+            spec = add(np.asarray(index))
+        spec['name'] = index.name
+        frame = {'index': spec, 'columns': []}
+        for column in value.columns:
+            values = value[column].values
+            if values.dtype.kind in 'biufcmM':
+                spec = add(values)
+            else:
+                spec = {'dtype': 'str', 'values': [str(v) for v in values]}
+            spec['name'] = column
+            frame['columns'].append(spec)
+        header['frames'][key] = frame
+        
+    header = json.dumps(header, default = _plain).encode('utf-8')
+    head = MAGIC + struct.pack('<I', len(header)) + header
+    return b''.join([head, b'\0' * _padding(len(head))] + buffers)
+
+
+def _read_header(payload):
+    payload = memoryview(payload)
+    if bytes(payload[:4]) != MAGIC:
+        raise ValueError('not a binary strategy report')
+    size = struct.unpack('<I', payload[4:8])[0]
+    header = json.loads(bytes(payload[8:8 + size]).decode('utf-8'))
+    if header['version'] != VERSION:
+        raise ValueError('unsupported report version %s' % header['version'])
+    return header, 8 + size + _padding(8 + size)
+
+
+def read_columns(payload):
+    # Zero-copy view of a binary report: (values, {frame: {'index': array,
+    # column: array, ...}}) with the arrays pointing into `payload`
+    header, base = _read_header(payload)
+    
+    def array(spec):
+        if spec['dtype'] == 'str':
+            return np.array(spec['values'], dtype = object)
+        return np.frombuffer(payload, dtype = spec['dtype'], count = spec['length'],
+                             offset = base + spec['offset'])
+    
+    frames = {}
+    for key, frame in header['frames'].items():
+        columns = OrderedDict([('index', array(frame['index']))])
+        for spec in frame['columns']:
+            columns[spec['name']] = array(spec)
+        frames[key] = columns
+    return header['values'], frames
+
+
+def decode_report(payload):
+    # Inverse of `encode_report`
+    header, _ = _read_header(payload)
+    values, frames = read_columns(payload)
+    report = dict(values)
+    for key, columns in frames.items():
+        spec = header['frames'][key]['index']
+        index = columns.pop('index')
+        if 'tz' in spec:
+            index = pd.DatetimeIndex(index, name = spec['name'])
+            if spec['tz'] is not None:
+                index = index.tz_localize('UTC').tz_convert(spec['tz'])
+        else:
+            index = pd.Index(index, name = spec['name'])
+        report[key] = pd.DataFrame(columns, index = index, columns = list(columns))
+    return report
+
+
+# Reports decoded in this process, keyed by the SHA-1 of their payload
+_decoded = OrderedDict()
+_decoding = {}
+_decoded_lock = threading.Lock()
+MAX_DECODED = 16
+
+
+def load_report(payload):
+    # Decode a binary report payload once per process: later calls with the same
+    # payload, including concurrent ones from parallel callbacks, get the same objects
+    key = hashlib.sha1(payload).hexdigest()
+    with _decoded_lock:
+        if key in _decoded:
+            _decoded.move_to_end(key)
+            return _decoded[key]
+        event = _decoding.get(key)
+        owner = event is None
+        if owner:
+            event = _decoding[key] = threading.Event()
+    
+    if not owner:
+        event.wait()
+        with _decoded_lock:
+            report = _decoded.get(key)
+        # The decoding thread failed or the entry was already evicted
+        return report if report is not None else load_report(payload)
+    
+    try:
+        report = decode_report(payload)
+        with _decoded_lock:
+            _decoded[key] = report
+            while len(_decoded) > MAX_DECODED:
+                _decoded.popitem(last = False)
+    finally:
+        with _decoded_lock:
+            del _decoding[key]
+        event.set()
+    return report
+
+
+class ReportStore(object):
+    # Server-side store for strategy reports so that only a run ID has to travel
+    # through the browser. Reports are kept as built objects in an in-process LRU.
+    # With `directory` set they are also written to disk, so that another worker
+    # process serving a later callback can still find them.
+    def __init__(self, max_items = 16, directory = None, max_age = 24 * 3600):
+        self.max_items = max_items
+        self.directory = directory
+        self.max_age = max_age
+        self._reports = OrderedDict()
+        self._lock = threading.Lock()
+
+    def put(self, report):
+        run_id = uuid.uuid4().hex
+        with self._lock:
+            self._reports[run_id] = report
+            while len(self._reports) > self.max_items:
+                self._reports.popitem(last = False)
+        if self.directory is not None:
+            self._write(run_id, report)
+        return run_id
+
+    def get(self, run_id):
+        # The report for `run_id`, or None if it is unknown or has expired
+        if not run_id:
+            return None
+        with self._lock:
+            report = self._reports.get(run_id)
+            if report is not None:
+                self._reports.move_to_end(run_id)
+                return report
+
+        report = self._read(run_id) if self.directory is not None else None
+        if report is not None:
+            with self._lock:
+                self._reports[run_id] = report
+                while len(self._reports) > self.max_items:
+                    self._reports.popitem(last = False)
+        return report
+
+    def payload(self, run_id):
+        # The binary encoding of a stored report, for API clients
+        path = self._path(run_id) if self.directory is not None else None
+        if path is not None and os.path.exists(path):
+            with open(path, 'rb') as f:
+                return f.read()
+        report = self.get(run_id)
+        return encode_report(report) if report is not None else None
+
+    def _path(self, run_id):
+        # Run IDs come back from the browser, only accept what `put` generates
+        if len(run_id) != 32 or not all(c in '0123456789abcdef' for c in run_id):
+            return None
+        return os.path.join(self.directory, run_id + '.rpt')
+
+    def _write(self, run_id, report):
+        os.makedirs(self.directory, exist_ok = True)
+        path = self._path(run_id)
+        tmp = path + '.tmp'
+        with open(tmp, 'wb') as f:
+            f.write(encode_report(report))
+        os.replace(tmp, path)
+
+        # Drop reports nobody has asked for in a while
+        now = time.time()
+        for name in os.listdir(self.directory):
+            name = os.path.join(self.directory, name)
+            try:
+                if now - os.path.getmtime(name) > self.max_age:
+                    os.remove(name)
+            except OSError:
+                pass
+
+    def _read(self, run_id):
+        path = self._path(run_id)
+        if path is None or not os.path.exists(path):
+            return None
+        with open(path, 'rb') as f:
+            return load_report(f.read())
@@ -0,0 +1,24 @@
+import os
+
+from app.tradingapp import lib
+from app.tradingapp import dataclient
+from app.tradingapp import reports
+
+
+
+# Clients shared by the Dash callbacks and the API blueprint, one per process.
+# Kept apart from callbacks so that importing them has no Dash side effects.
+
+# The Alpha Vantage quota is per API key, every server process gets an equal
+# share: ALPHA_VANTAGE_CALLS_PER_MINUTE for the key, divided by the number of
+# processes calling it in ALPHA_VANTAGE_PROCESSES (by default WEB_CONCURRENCY,
+# which gunicorn also reads as its --workers default)
+processes = int(os.environ.get('ALPHA_VANTAGE_PROCESSES', os.environ.get('WEB_CONCURRENCY', 1)))
+calls_per_minute = float(os.environ.get('ALPHA_VANTAGE_CALLS_PER_MINUTE', 5)) / processes
+
+#Get data from Alpha Vantage, one pooled and rate limited client per process
+lib.init()
+ts = dataclient.DataClient(lib.api_key, calls_per_minute = calls_per_minute)
+#Strategy reports are kept server-side, the page only holds their run ID.
+#They are also written to disk so every gunicorn worker can serve them.
+report_store = reports.ReportStore(directory = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'data', 'reports'))
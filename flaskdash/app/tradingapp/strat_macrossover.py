@@ -70,15 +70,25 @@ def score(paras):
     return -sharpe_ratio
 
 
-def run_strat(df, interval = 'daily'):
+def run_strat(df, interval = 'daily', progress = None):
     commission = 0.0015
+    max_evals = 100
         
     #Tuning hyperparameter
     fspace = {'df': df, 'commission': commission, 'interval': interval, \
               'short_window':hp.quniform('short_window', 5, 25, 1), \
               'long_window':hp.quniform('long_window', 50, 200, 10)}
     
-    best = fmin(fn = score, space = fspace, algo = tpe.suggest, max_evals = 100)
+    #progress(done, total) is called after every trial, it may raise to stop the search
+    n_done = [0]
+    def objective(paras):
+        loss = score(paras)
+        n_done[0] += 1
+        if progress is not None:
+            progress(n_done[0], max_evals)
+        return loss
+    
+    best = fmin(fn = objective, space = fspace, algo = tpe.suggest, max_evals = max_evals)
     print(best)
     
     #Run strategy with new parameters
@@ -87,22 +97,23 @@ def run_strat(df, interval = 'daily'):
     signals = find_signals(paras_best)
     
     portfolio, port_intraday = lib.compute_portfolio(df, signals, commission, interval)
-    backtest_data = lib.backtesting(portfolio)
+    backtest_data = lib.backtesting(portfolio, shares = 100 * signals['signal'].values, prices = df['Close'].values)
     backtest_data['optimal_paras'] = {'short_window': best['short_window'], \
                                       'long_window': best['long_window']} 
 
     report_dict = {
-            'df': df.to_json(orient = 'split', date_format = 'iso'),
+            'df': df,
             'commission': commission,
-            'daily_drawdown': backtest_data['daily_drawdown'].to_json(orient = 'split', date_format = 'iso'),
-            'max_daily_drawdown': backtest_data['max_daily_drawdown'].to_json(orient = 'split', date_format = 'iso'),
+            'daily_drawdown': backtest_data['daily_drawdown'],
+            'max_daily_drawdown': backtest_data['max_daily_drawdown'],
             'cummulative_return': backtest_data['cummulative_return'],
             'sharpe_ratio': backtest_data['sharpe_ratio'],
             'cagr': backtest_data['cagr'],
+            'metrics': dict(backtest_data['metrics']._asdict()),
             'optimal_paras': backtest_data['optimal_paras'],
-            'signals': signals.to_json(orient = 'split', date_format = 'iso'),
-            'portfolio': portfolio.to_json(orient = 'split', date_format = 'iso'),
-            'port_intraday': port_intraday.to_json(orient = 'split', date_format = 'iso'),
+            'signals': signals,
+            'portfolio': portfolio,
+            'port_intraday': port_intraday,
             }
         
     return report_dict
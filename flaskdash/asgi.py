@@ -0,0 +1,10 @@
+"""ASGI entry point for the market data endpoints (/ts, /yf, their streams and /batch).
+
+It runs as its own process beside the gunicorn Flask app, see runserver.sh.
+Use "uvicorn asgi:app --host 0.0.0.0 --port 5001" to serve it.
+"""
+
+from app.controllers.apis import sources
+from app.controllers.async_apis import MarketDataApp
+
+app = MarketDataApp(sources)
@@ -1,2 +1,9 @@
 source venv/bin/activate
-nohup gunicorn --bind 0.0.0.0:5000 --workers 4 --max-requests 100  --reload unicorn:app &
+# Each process calling Alpha Vantage takes its share of the quota, see app/tradingapp/services.py
+export WEB_CONCURRENCY=4
+export ALPHA_VANTAGE_PROCESSES=$((WEB_CONCURRENCY + 1))
+nohup gunicorn --bind 0.0.0.0:5000 --workers $WEB_CONCURRENCY --max-requests 100  --reload unicorn:app &
+# Market data endpoints and their SSE streams (/ts, /yf, /batch) on asyncio, in one
+# process so that every poll shares its cache. The pages load them from port 5001 of
+# their host, or from MARKET_DATA_URL when this runs elsewhere (see app/settings.py).
+nohup uvicorn asgi:app --host 0.0.0.0 --port 5001 --workers 1 &
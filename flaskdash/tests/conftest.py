@@ -6,6 +6,13 @@
 #
 # Authors: Ling Thio <ling.thio@gmail.com>
 
+import json
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from socketserver import ThreadingMixIn
+from urllib.parse import urlparse, parse_qs
+
 import pytest
 from app import create_app, db as the_db
 
@@ -61,3 +68,52 @@ def session(db, request):
 def client(app):
     return app.test_client()
 
+
+class StubServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+def make_handler(calls):
+    class Handler(BaseHTTPRequestHandler):
+        def log_message(self, *args):
+            pass
+
+        def do_GET(self):
+            query = {k: v[0] for k, v in parse_qs(urlparse(self.path).query).items()}
+            calls.append(query)
+            time.sleep(0.1)  # Keep the request in flight while others arrive
+            if query['symbol'] == 'BAD':
+                body = {'Error Message': 'Invalid API call.'}
+            elif query['symbol'] == 'BUSY' and [call['symbol'] for call in calls].count('BUSY') == 1:
+                # The quota message, on the first call only
+                body = {'Note': 'Thank you for using Alpha Vantage! Our standard API call frequency is 5 calls per minute.'}
+            else:
+                body = {
+                    'Meta Data': {'2. Symbol': query['symbol']},
+                    'Time Series ({})'.format(query['interval']): {
+                        '2020-01-02 10:00:00': {'1. open': '1.5', '2. high': '2.0', '3. low': '1.0',
+                                                '4. close': '1.7', '5. volume': '100'},
+                        '2020-01-02 09:00:00': {'1. open': '1.4', '2. high': '2.0', '3. low': '1.0',
+                                                '4. close': '1.5', '5. volume': '90'},
+                    }
+                }
+            data = json.dumps(body).encode('utf-8')
+            self.send_response(200)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+    return Handler
+
+
+@pytest.fixture
+def stub():
+    """ A local stand-in for the Alpha Vantage API: yields (url, list of the queries received). """
+    calls = []
+    server = StubServer(('127.0.0.1', 0), make_handler(calls))
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    yield 'http://127.0.0.1:{}/query'.format(server.server_port), calls
+    server.shutdown()
+    server.server_close()
@@ -0,0 +1,129 @@
+# Tests for the API response cache, fetching through the stub server of conftest.py
+
+import threading
+import time
+
+import pandas as pd
+
+from app.controllers import apis
+from app.tradingapp import apicache, dataclient
+
+
+def fetcher(url, computed):
+    client = dataclient.DataClient('key', base_url=url, calls_per_minute=600)
+
+    def fetch(ticker, interval='60min'):
+        computed.append(ticker)
+        df, meta_data = client.get_intraday(ticker, interval=interval)
+        return df.reset_index()
+    return fetch
+
+
+def get_concurrently(cache, fetch, ticker, n=8):
+    results = []
+
+    def get():
+        try:
+            results.append(cache.get(('ts', ticker, '60min'), '60min', lambda: fetch(ticker)))
+        except Exception as e:
+            results.append(e)
+    threads = [threading.Thread(target=get) for _ in range(n)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return results
+
+
+def test_concurrent_misses_fetch_once(stub):
+    url, calls = stub
+    computed = []
+    results = get_concurrently(apicache.ResponseCache(), fetcher(url, computed), 'IBM')
+
+    assert len(computed) == 1
+    assert len(calls) == 1
+    assert all(entry is results[0] for entry in results)
+    assert results[0].last == 1577959200000  # 2020-01-02 10:00
+
+
+def test_failed_fetch_fails_its_waiters(stub):
+    url, calls = stub
+    computed = []
+    results = get_concurrently(apicache.ResponseCache(), fetcher(url, computed), 'BAD')
+
+    assert len(results) == 8
+    assert all(isinstance(error, ValueError) for error in results)
+    assert len(computed) == 1
+    assert len(calls) == 1
+
+
+def test_entry_expires_at_next_bar(stub):
+    assert apicache.ResponseCache.expiry('60min', 5 * 3600 + 10) == 6 * 3600
+    assert apicache.ResponseCache.expiry('1m', 125) == 180
+
+    url, calls = stub
+    cache = apicache.ResponseCache()
+    fetch = fetcher(url, [])
+    entry = cache.get(('ts', 'IBM', '60min'), '60min', lambda: fetch('IBM'))
+    assert cache.get(('ts', 'IBM', '60min'), '60min', lambda: fetch('IBM')) is entry
+    assert len(calls) == 1
+
+    entry.expires = 0
+    assert cache.get(('ts', 'IBM', '60min'), '60min', lambda: fetch('IBM')) is not entry
+    assert len(calls) == 2
+
+
+def test_refetch_without_new_bar_retries_soon():
+    bars = pd.DataFrame({'date': pd.to_datetime(['2020-01-02 09:00', '2020-01-02 10:00']), 'close': [1.0, 2.0]})
+    key = ('ts', 'IBM', '60min')
+    cache = apicache.ResponseCache()
+    assert cache.get(key, '60min', lambda: bars).retry == 0
+
+    retries = []
+    for _ in range(3):
+        cache._entries[key].expires = 0
+        entry = cache.get(key, '60min', lambda: bars)
+        retries.append(entry.retry)
+    assert retries == [15, 30, 60]
+    assert entry.expires <= time.time() + 60
+
+    # The bar is published: back to the bar boundary
+    cache._entries[key].expires = 0
+    newer = pd.concat([bars, pd.DataFrame({'date': [pd.Timestamp('2020-01-02 11:00')], 'close': [3.0]})])
+    entry = cache.get(key, '60min', lambda: newer)
+    assert entry.retry == 0
+    assert entry.expires == apicache.ResponseCache.expiry('60min', time.time())
+
+
+def test_ts_etag(client, stub, monkeypatch):
+    url, calls = stub
+    monkeypatch.setattr(apis, 'ts', dataclient.DataClient('key', base_url=url, calls_per_minute=600))
+    monkeypatch.setattr(apis, 'response_cache', apicache.ResponseCache())
+
+    response = client.get('/ts?ticker=ibm')
+    assert response.status_code == 200
+    etag = response.headers['ETag']
+    assert response.get_json()[0][4] == 1.7
+
+    response = client.get('/ts?ticker=IBM', headers={'If-None-Match': etag})
+    assert response.status_code == 304
+    assert len(calls) == 1
+
+
+def test_batch(client, stub, monkeypatch):
+    url, calls = stub
+    monkeypatch.setattr(apis, 'ts', dataclient.DataClient('key', base_url=url, calls_per_minute=600))
+    monkeypatch.setattr(apis, 'response_cache', apicache.ResponseCache())
+
+    response = client.get('/batch?source=ts&interval=60min&tickers=ibm,BAD,IBM,msft')
+    assert response.status_code == 200
+    data = response.get_json()
+    assert sorted(data['symbols']) == ['IBM', 'MSFT']
+    assert data['symbols']['IBM']['Close'] == [1.7, 1.5]
+    # Only the exception type, upstream messages can contain the API key
+    assert data['errors'] == {'BAD': 'ValueError'}
+    assert len(calls) == 3
+
+    # Intervals of the other provider are rejected before reaching the upstream
+    assert client.get('/batch?source=ts&interval=5m&tickers=IBM').status_code == 400
+    assert len(calls) == 3
@@ -0,0 +1,93 @@
+# Tests for the shared Alpha Vantage client, run against the stub server of conftest.py
+
+import threading
+import time
+
+import pytest
+
+from app.tradingapp import dataclient
+
+
+def test_get_intraday(stub):
+    url, calls = stub
+    client = dataclient.DataClient('key', base_url=url, calls_per_minute=600)
+    df, meta_data = client.get_intraday('ibm', interval='60min', outputsize='full')
+
+    assert list(df.columns) == ['1. open', '2. high', '3. low', '4. close', '5. volume']
+    assert df.index.name == 'date'
+    assert df['4. close'].iloc[0] == 1.7
+    assert meta_data['2. Symbol'] == 'IBM'
+    assert calls[0]['apikey'] == 'key'
+
+
+def test_duplicate_requests_are_coalesced(stub):
+    url, calls = stub
+    client = dataclient.DataClient('key', base_url=url, calls_per_minute=600)
+    results = []
+    threads = [threading.Thread(target=lambda: results.append(client.get_intraday('IBM', interval='60min')))
+               for _ in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert len(results) == 8
+    assert len(calls) == 1
+
+
+def test_prefetch_is_rate_limited(stub):
+    url, calls = stub
+    client = dataclient.DataClient('key', base_url=url)
+    client.bucket = dataclient.TokenBucket(5, per=1.0, capacity=1)
+    start = time.time()
+    results = client.prefetch(['A', 'B', 'C', 'BAD'], interval='5min')
+
+    assert time.time() - start >= 0.6
+    assert len(calls) == 4
+    assert isinstance(results['BAD'], ValueError)
+    assert results['A'][0].shape == (2, 5)
+
+
+def test_max_wait_fails_fast(stub):
+    url, calls = stub
+    client = dataclient.DataClient('key', base_url=url, calls_per_minute=1)
+    client.get_intraday('IBM', interval='60min')
+    start = time.time()
+    with pytest.raises(dataclient.RateLimitError):
+        client.get_intraday('MSFT', interval='60min', max_wait=1.0)
+
+    assert time.time() - start < 0.5
+    assert len(calls) == 1
+
+
+def test_quota_backoff_respects_max_wait(stub):
+    url, calls = stub
+    client = dataclient.DataClient('key', base_url=url, calls_per_minute=1)
+    start = time.time()
+    with pytest.raises(dataclient.RateLimitError):
+        client.get_intraday('BUSY', interval='60min', max_wait=1.0)
+
+    assert time.time() - start < 1.0
+    assert len(calls) == 1
+
+
+def test_waiter_without_max_wait_fetches_again(stub):
+    url, calls = stub
+    client = dataclient.DataClient('key', base_url=url)
+    client.bucket = dataclient.TokenBucket(2, per=1.0, capacity=1)
+    results = {}
+
+    def get(name, max_wait):
+        try:
+            results[name] = client.get_intraday('BUSY', interval='60min', max_wait=max_wait)
+        except Exception as e:
+            results[name] = e
+    owner = threading.Thread(target=get, args=('batch', 0.3))
+    owner.start()
+    time.sleep(0.05)  # Join the owner's request while it is in flight
+    get('plain', None)
+    owner.join()
+
+    assert isinstance(results['batch'], dataclient.RateLimitError)
+    assert results['plain'][0].shape == (2, 5)
+    assert len(calls) == 2
@@ -0,0 +1,52 @@
+# Tests for the local bar store
+
+import numpy as np
+import pandas as pd
+
+from app.tradingapp import datastore
+
+
+def daily_bars(start, end):
+    index = pd.date_range(start, end, freq='D')
+    return pd.DataFrame({'Close': np.arange(len(index), dtype=float)}, index=index)
+
+
+def test_extend_by_one_bar_fetches_the_new_bar(tmpdir):
+    store = datastore.BarStore(str(tmpdir))
+    calls = []
+
+    def fetch(start, end):
+        calls.append((start, end))
+        return daily_bars(start, end)
+
+    store.read('IBM', 'daily', '2020-01-01', '2020-01-10', fetch=fetch)
+    df = store.read('IBM', 'daily', '2020-01-01', '2020-01-11', fetch=fetch)
+
+    assert calls[-1] == (pd.Timestamp('2020-01-10'), pd.Timestamp('2020-01-11'))
+    assert df.index[-1] == pd.Timestamp('2020-01-11')
+
+
+def test_covered_range_is_not_refetched(tmpdir):
+    store = datastore.BarStore(str(tmpdir))
+    store.write('IBM', 'daily', daily_bars('2020-01-01', '2020-01-10'), pd.Timestamp('2020-01-01'),
+                pd.Timestamp('2020-01-10'))
+
+    assert store.missing('IBM', 'daily', pd.Timestamp('2020-01-02'), pd.Timestamp('2020-01-10')) == []
+    # Less than one bar past the covered range
+    assert store.missing('IBM', 'daily', pd.Timestamp('2020-01-02'), pd.Timestamp('2020-01-10 12:00')) == []
+
+
+def test_empty_first_fetch_keeps_price_columns(tmpdir):
+    store = datastore.BarStore(str(tmpdir))
+
+    def fetch(start, end):
+        if end < pd.Timestamp('2020-01-06'):
+            # Nothing over the weekend, and no dtypes to take the columns from
+            return pd.DataFrame(columns=['Open', 'Close'], index=pd.DatetimeIndex([]))
+        return daily_bars(start, end).assign(Open=1.0)
+
+    assert len(store.read('IBM', 'daily', '2020-01-04', '2020-01-05', fetch=fetch)) == 0
+    df = store.read('IBM', 'daily', '2020-01-04', '2020-01-31', fetch=fetch)
+
+    assert sorted(df.columns) == ['Close', 'Open']
+    assert len(df) == 27
@@ -2,8 +2,17 @@ import matplotlib.pyplot as plt
 from matplotlib import style
 import numpy as np
 import pandas as pd
+from collections import OrderedDict, deque, namedtuple
+import glob
+import os
+import shutil
+import tempfile
+import threading
+import weakref
 style.use('ggplot')
 
+import metrics
+
 
 
 def init():
@@ -21,9 +30,9 @@ def preprocessing(df):
     ]
     df.reset_index(inplace = True, drop = True)
     df.rename(columns = col_dict,inplace=True)
-    df['DateTime'] = df['Date'] + ' ' + df['Time']
-    df['DateTime'] = pd.to_datetime(df['DateTime'],format='%d-%b-%y %H:%M:%S')
-    df.sort_values(by = ['DateTime'],inplace=True)
+    df['DateTime'] = parse_tick_timestamps(df['Date'], df['Time']).view('M8[ns]')
+    # Stable, so the last tick of a repeated timestamp is the last one in the file
+    df.sort_values(by = ['DateTime'], kind = 'mergesort', inplace=True)
     df.drop_duplicates(subset=['DateTime'],keep='last',inplace=True)
     df.set_index('DateTime',inplace=True)
     df.drop(['Time'],axis=1,inplace=True)
@@ -47,27 +56,247 @@ def preprocessing(df):
     return df
     
     
-def compute_portfolio(df, signals, commission, interval):
-    initial_capital= float(100000.0)
-    position = pd.DataFrame(index=signals.index).fillna(0.0)
-    
-    # Buy a 100 shares
-    position['daily_df'] = 100 * signals['signal']     
-    # Initialize the portfolio with value owned   
-    portfolio = position.multiply(df['Close'], axis=0)
-    # Store the difference in shares owned 
-    pos_diff = position.diff()
-    
-    # Add `holdings` to portfolio
-    portfolio['holdings'] = (position.multiply(df['Close'], axis=0)).sum(axis=1)
-    # Add `cost` to portfolio
-    portfolio['cost'] = 100 * df['Close'] * commission * signals['position'].abs()
-    # Add `cash` to portfolio
-    portfolio['cash'] = initial_capital - (pos_diff.multiply(df['Close'], axis=0)).sum(axis=1).cumsum()   
-    # Add `total` to portfolio
-    portfolio['total'] = portfolio['cash'] + portfolio['holdings']    
-    # Add `returns` to portfolio
-    portfolio['returns'] = portfolio['total'].pct_change()
+# Nanosecond timestamps of the 'dd-Mon-yy' dates parsed so far
+_tick_dates = {}
+
+
+def parse_tick_timestamps(dates, times):
+    # Exchange tick dates ('dd-Mon-yy') and times ('HH:MM:SS') to int64 nanoseconds,
+    # as pd.to_datetime(dates + ' ' + times, format='%d-%b-%y %H:%M:%S') would give.
+    # A tick file only has a few hundred distinct dates and at most 86400 distinct
+    # times, so each distinct value is parsed once and the rows are combined with
+    # integer arithmetic. Missing dates or times give NaT.
+    date_codes, date_values = pd.factorize(np.asarray(dates, dtype = object))
+    new = [d for d in date_values if d not in _tick_dates]
+    if new:
+        parsed = pd.to_datetime(pd.Index(new), format = '%d-%b-%y')
+        _tick_dates.update(zip(new, np.asarray(parsed.values, dtype = 'M8[ns]').view('i8')))
+    # Missing values have code -1, which picks the 0 appended to each lookup
+    # table and is set to NaT below. This also works when a column is all NaN.
+    day_ns = np.array([_tick_dates[d] for d in date_values] + [0], dtype = 'i8')
+    
+    time_codes, time_values = pd.factorize(np.asarray(times, dtype = object))
+    hms = np.zeros((0, 3), dtype = int)
+    if len(time_values) > 0:
+        hms = pd.Series(time_values, dtype = object).str.split(':', expand = True)
+        if hms.shape[1] != 3:
+            raise ValueError('time data does not match format %H:%M:%S')
+        hms = hms.astype(int).values
+        if ((hms < 0) | (hms > [23, 59, 59])).any():
+            raise ValueError('time data does not match format %H:%M:%S')
+    second_ns = np.append((hms[:, 0] * 3600 + hms[:, 1] * 60 + hms[:, 2]) * 10 ** 9, 0)
+    
+    stamps = day_ns[date_codes] + second_ns[time_codes]
+    stamps[(date_codes < 0) | (time_codes < 0)] = np.iinfo(np.int64).min
+    return stamps
+
+
+def preprocessing_chunked(path, chunksize = 1000000, workdir = None):
+    # Same output as `preprocessing(pd.read_csv(path))` for tick files too big
+    # to load at once. Ticks are read in chunks and spilled to one .npy file per
+    # day and chunk, then each day is sorted, de-duplicated (keeping the last
+    # tick of a timestamp in file order) and binned into 5-minute bars, so memory
+    # is bounded by the chunk size and the busiest trading day.
+    columns = ['OPENPRICE', 'HIGHPRICE', 'LOWPRICE', 'LASTPRICE', 'TOTALQTTY']
+    names = ['Open', 'High', 'Low', 'Close', 'Volume']
+    dtype = np.dtype([('t', 'i8')] + [(name, 'f8') for name in names])
+    day_ns = 24 * 3600 * 10 ** 9
+    bar_ns = 5 * 60 * 10 ** 9
+    start_ns = pd.Timestamp('2018-01-01').value
+    
+    spill = tempfile.mkdtemp(dir = workdir)
+    try:
+        # Spill the ticks after 2017 by day
+        dtypes = {}
+        reader = pd.read_csv(path, usecols = ['TRADINGDATE', 'TRADINGTIME'] + columns, chunksize = chunksize)
+        for i, chunk in enumerate(reader):
+            for column, name in zip(columns, names):
+                dtypes[name] = np.result_type(dtypes.get(name, chunk[column].dtype), chunk[column].dtype)
+            stamps = parse_tick_timestamps(chunk['TRADINGDATE'], chunk['TRADINGTIME'])
+            keep = stamps >= start_ns
+            ticks = np.zeros(keep.sum(), dtype = dtype)
+            ticks['t'] = stamps[keep]
+            for column, name in zip(columns, names):
+                ticks[name] = chunk[column].values[keep]
+            days = ticks['t'] // day_ns
+            for day in np.unique(days):
+                np.save(os.path.join(spill, '%d_%08d.npy' % (day, i)), ticks[days == day])
+        
+        # Resample day by day, continuing the 5-minute grid across the gaps
+        bars = []
+        next_label = None
+        files = sorted(glob.glob(os.path.join(spill, '*.npy')))
+        for day in sorted(set(int(os.path.basename(f).split('_')[0]) for f in files)):
+            ticks = np.concatenate([np.load(f, mmap_mode = 'r') for f in files
+                                    if os.path.basename(f).startswith('%d_' % day)])
+            ticks = ticks[np.argsort(ticks['t'], kind = 'mergesort')]
+            ticks = ticks[np.append(ticks['t'][1:] != ticks['t'][:-1], True)]
+            
+            first_label = ticks['t'][0] // bar_ns * bar_ns if next_label is None else next_label
+            labels = np.arange(first_label, ticks['t'][-1] // bar_ns * bar_ns + 1, bar_ns)
+            # Prices of the first tick at or after each label (backward fill),
+            # volume summed over each bar
+            day_bars = ticks[np.searchsorted(ticks['t'], labels, side = 'left')]
+            day_bars['t'] = labels
+            day_bars['Volume'] = np.bincount((ticks['t'] - first_label) // bar_ns,
+                                             weights = np.nan_to_num(ticks['Volume']),
+                                             minlength = len(labels))
+            bars.append(day_bars)
+            next_label = labels[-1] + bar_ns
+    finally:
+        shutil.rmtree(spill, ignore_errors = True)
+        
+    bars = np.concatenate(bars) if bars else np.zeros(0, dtype = dtype)
+    df = pd.DataFrame({name: bars[name] for name in names}, columns = names,
+                      index = pd.DatetimeIndex(bars['t'].view('M8[ns]'), name = 'DateTime', freq = '5min'))
+    # Integer columns stay integer as long as no bar is missing a value
+    for name in names:
+        if dtypes.get(name, np.dtype(float)).kind in 'iu' and not df[name].isnull().any():
+            df[name] = df[name].astype(dtypes[name])
+    
+    return df
+    
+    
+def portfolio_kernel(close, signal, commission, initial_capital = 100000.0):
+    # NumPy core of `compute_portfolio`: holds 100 shares while `signal` is 1.
+    # `signal` is indexed by bar along its last axis, so a (n_strategies, n_bars)
+    # matrix is evaluated in one call. Returns a dict of arrays shaped like `signal`.
+    close = np.asarray(close, dtype = float)
+    signal = np.asarray(signal, dtype = float)
+    position = 100 * signal
+    # Missing prices contribute nothing, like the skipna sums of the DataFrame version
+    holdings = np.nan_to_num(position * close)
+    pos_diff = np.diff(position, axis = -1, prepend = position[..., :1])
+    cash = initial_capital - np.nan_to_num(pos_diff * close).cumsum(axis = -1)
+    total = cash + holdings
+    
+    returns = np.full(total.shape, np.nan)
+    trades = np.full(signal.shape, np.nan)
+    with np.errstate(invalid = 'ignore', divide = 'ignore'):
+        returns[..., 1:] = total[..., 1:] / total[..., :-1] - 1
+    trades[..., 1:] = np.abs(np.diff(signal, axis = -1))
+    cost = 100 * close * commission * trades
+    
+    return {'position': position, 'holdings': holdings, 'cash': cash,
+            'total': total, 'returns': returns, 'cost': cost}
+    
+
+# Execution assumptions for `execution_kernel`. `commission` is a fraction of
+# the traded value and `fixed` a flat fee per trade, `slippage_bps` moves every
+# fill against the trade. `fill` is 'close' (the bar of the signal) or
+# 'next_open'. Each trade buys `shares` shares, or, when `capital_fraction` is
+# set, as many shares as that fraction of the current equity pays for.
+CostModel = namedtuple('CostModel', ['commission', 'fixed', 'slippage_bps', 'fill', 'shares', 'capital_fraction'])
+CostModel.__new__.__defaults__ = (0.0015, 0.0, 0.0, 'close', 100, None)
+
+
+def _fraction_sizes(target, fill, fraction, commission, fixed, initial_capital):
+    # Shares held after each trade when sizing by a fraction of the equity. The
+    # cash depends on every earlier fill, so this walks the trades (not the bars).
+    sizes = []
+    cash = initial_capital
+    held = 0.0
+    for target_k, price in zip(target.tolist(), fill.tolist()):
+        equity = cash + held * price
+        size = np.floor(max(fraction * target_k * equity - fixed, 0.0) / (price * (1 + commission)))
+        delta = size - held
+        cash -= delta * price + abs(delta) * price * commission + fixed
+        held = size
+        sizes.append(size)
+    return np.array(sizes)
+
+
+def execution_kernel(open_prices, close, signal, costs, initial_capital = 100000.0):
+    # `portfolio_kernel` with trading costs: fees and slippage are paid out of
+    # the cash, fills follow `costs.fill` and the size `costs.shares` or
+    # `costs.capital_fraction` (see CostModel). The portfolio starts flat and is
+    # valued at the close. Works on one series, returns the same dict of arrays.
+    close = np.asarray(close, dtype = float)
+    signal = np.nan_to_num(np.asarray(signal, dtype = float))
+    n = len(signal)
+    if costs.fill == 'next_open':
+        # Decided on the bar's close, filled at the following open
+        price = np.asarray(open_prices, dtype = float)
+        target = np.concatenate(([0.0], signal[:-1]))
+    else:
+        price = close
+        target = signal
+    # Bars without a quote fill at the last known price
+    price = pd.Series(price).fillna(method = 'ffill').values
+    # Before the first quote there is nothing to fill at, the portfolio stays
+    # flat and the trade is deferred to the first bar with a price
+    target = np.where(np.isnan(price), 0.0, target)
+
+    change = np.diff(target, prepend = 0.0)
+    trade = np.flatnonzero(change != 0)
+    slippage = costs.slippage_bps / 10000.0 * np.sign(change[trade])
+    fill = price[trade] * (1 + slippage)
+    if costs.capital_fraction is None:
+        size = costs.shares * target[trade]
+    else:
+        size = _fraction_sizes(target[trade], fill, costs.capital_fraction, costs.commission, \
+                               costs.fixed, initial_capital)
+    delta = np.diff(size, prepend = 0.0)
+    fees = np.abs(delta) * fill * costs.commission + costs.fixed
+
+    position = np.zeros(n)
+    position[trade] = delta
+    position = position.cumsum()
+    flows = np.zeros(n)
+    flows[trade] = -delta * fill - fees
+    cash = initial_capital + flows.cumsum()
+    cost = np.zeros(n)
+    cost[trade] = fees + np.abs(delta * (fill - price[trade]))
+
+    holdings = np.nan_to_num(position * close)
+    total = cash + holdings
+    returns = np.full(n, np.nan)
+    with np.errstate(invalid = 'ignore', divide = 'ignore'):
+        returns[1:] = total[1:] / total[:-1] - 1
+    
+    return {'position': position, 'holdings': holdings, 'cash': cash,
+            'total': total, 'returns': returns, 'cost': cost}
+
+
+def _kernel(df, signal, commission, costs):
+    if costs is None:
+        return portfolio_kernel(df['Close'].values, signal, commission)
+    return execution_kernel(df['Open'].values, df['Close'].values, signal, costs)
+
+
+def daily_returns(df, returns, interval):
+    # The returns `compute_portfolio` keeps in its daily portfolio: intraday
+    # returns are summed per calendar day, bars or days without a close are dropped
+    close = df['Close'].values
+    if interval != 'daily':
+        days = df.index.normalize().values
+        starts = np.flatnonzero(np.concatenate(([True], days[1:] != days[:-1])))
+        has_close = np.add.reduceat(~np.isnan(close), starts) > 0
+        returns = np.add.reduceat(np.nan_to_num(returns), starts, axis = -1)
+        return returns[..., has_close]
+    keep = ~np.isnan(close)
+    keep[0] = False
+    return returns[..., keep]
+
+
+def portfolio_returns(df, signal, commission, interval, costs = None):
+    # Daily returns only, for optimiser scores that don't need the portfolio frames.
+    # With a CostModel in `costs` the returns are net of trading costs.
+    returns = _kernel(df, signal, commission, costs)['returns']
+    return daily_returns(df, returns, interval)
+
+
+def compute_portfolio(df, signals, commission, interval, costs = None):
+    kernel = _kernel(df, signals['signal'].values, commission, costs)
+    
+    portfolio = pd.DataFrame({
+            'daily_df': kernel['position'] * df['Close'].values,
+            'holdings': kernel['holdings'],
+            'cost': kernel['cost'],
+            'cash': kernel['cash'],
+            'total': kernel['total'],
+            'returns': kernel['returns']
+            }, index = signals.index, columns = ['daily_df', 'holdings', 'cost', 'cash', 'total', 'returns'])
     
     port_intraday = portfolio.copy()
     
@@ -83,6 +312,81 @@ def compute_portfolio(df, signals, commission, interval):
     portfolio.dropna(inplace = True)
     
     return portfolio, port_intraday
+
+
+class RollingCache(object):
+    # LRU cache of rolling mean/std arrays keyed by (frame, column, window, min_periods).
+    # Frames are identified by id() and must not be modified in place once cached;
+    # their entries are dropped when the frame is garbage collected. The finalizer
+    # only queues the id: it can run on a thread that holds the lock (cyclic GC
+    # inside get), so the entries are dropped on the next call instead.
+    def __init__(self, max_bytes = 256 * 1024 * 1024):
+        self.max_bytes = max_bytes
+        self.nbytes = 0
+        self._data = OrderedDict()
+        self._finalizers = {}
+        self._dropped = deque()
+        self._lock = threading.Lock()
+        
+    def get(self, df, column, window, min_periods, stat):
+        window = int(window)
+        min_periods = window if min_periods is None else int(min_periods)
+        key = (id(df), column, window, min_periods, stat)
+        with self._lock:
+            self._drop_frames()
+            values = self._data.get(key)
+            if values is not None:
+                self._data.move_to_end(key)
+                return values
+        
+        rolling = df[column].rolling(window, min_periods = min_periods)
+        values = np.asarray(getattr(rolling, stat)().values, dtype = float)
+        values.setflags(write = False)
+        
+        with self._lock:
+            self._drop_frames()
+            if key not in self._data:
+                self._data[key] = values
+                self.nbytes += values.nbytes
+            if id(df) not in self._finalizers:
+                self._finalizers[id(df)] = weakref.finalize(df, self._drop_frame, id(df))
+            # Evict least recently used entries, but always keep the newest one
+            while self.nbytes > self.max_bytes and len(self._data) > 1:
+                _, old = self._data.popitem(last = False)
+                self.nbytes -= old.nbytes
+        return values
+    
+    def clear(self):
+        with self._lock:
+            self._drop_frames()
+            self._data.clear()
+            self.nbytes = 0
+            
+    def _drop_frame(self, frame_id):
+        # deque.append is atomic, no lock needed
+        self._dropped.append(frame_id)
+
+    def _drop_frames(self):
+        # Called with the lock held. A dropped frame's id can be reused by a new
+        # frame, so this runs before every lookup.
+        while self._dropped:
+            frame_id = self._dropped.popleft()
+            self._finalizers.pop(frame_id, None)
+            for key in [k for k in self._data if k[0] == frame_id]:
+                self.nbytes -= self._data.pop(key).nbytes
+
+
+rolling_cache = RollingCache()
+
+
+def rolling_mean(df, column, window, min_periods = None):
+    values = rolling_cache.get(df, column, window, min_periods, 'mean')
+    return pd.Series(values, index = df.index, name = column)
+
+
+def rolling_std(df, column, window, min_periods = None):
+    values = rolling_cache.get(df, column, window, min_periods, 'std')
+    return pd.Series(values, index = df.index, name = column)
     
 
 def plot_portfolio(signals, portfolio):
@@ -105,39 +409,37 @@ def plot_portfolio(signals, portfolio):
     
 # Calculate Sharpe Ratio - Risk free rate element excluded for simplicity
 def annualised_sharpe(returns, window = 252):
+    # Works on a Series, an array or row-wise on a matrix of returns
     try:
-        return np.sqrt(window) * (returns.mean() / returns.std())
+        returns = np.asarray(returns, dtype = float)
+        with np.errstate(invalid = 'ignore', divide = 'ignore'):
+            return np.sqrt(window) * (np.nanmean(returns, axis = -1) / np.nanstd(returns, axis = -1, ddof = 1))
     except:
         return 0.0
         
     
-def backtesting(portfolio, window = 252):
+def backtesting(portfolio, window = 252, shares = None, prices = None):
     df_close = portfolio['daily_df']
     # Calculate the max drawdown in the past window days for eachs day 
-    rolling_max = df_close.rolling(window, min_periods=1).max()
-    daily_drawdown = df_close/rolling_max - 1.0
+    rolling_max = metrics.rolling_max(df_close.values, window)
+    with np.errstate(invalid = 'ignore', divide = 'ignore'):
+        daily_drawdown = df_close.values / rolling_max - 1.0
     # Calculate the minimum (negative) daily drawdown
-    max_daily_drawdown = daily_drawdown.rolling(window, min_periods=1).min()
-    
-    returns = portfolio['returns']
-    # Compute cummulative return
-    print('Cummulative return: {:.2%}'.format(returns.cumsum()[-1]))
-    # Compute annualized Sharpe ratio
-    sharpe_ratio = annualised_sharpe(returns)
-    print('Annualized Sharpe ratio: %.2f' % (sharpe_ratio))
+    max_daily_drawdown = metrics.rolling_min(daily_drawdown, window)
     
-    # Get the number of days in data
-    days = (df_close.index[-1] - df_close.index[0]).days
-    # Calculate the CAGR 
-    cagr = ((((df_close[-1]) / df_close[1])) ** (365.0/days)) - 1
-    print('CAGR: {:.2%}'.format(cagr))
+    # Performance of the strategy's portfolio value, turnover needs the
+    # position in `shares` and the `prices` traded at (bar by bar)
+    days = (portfolio.index[-1] - portfolio.index[0]).days
+    result = metrics.compute(portfolio['total'].values, portfolio['returns'].values, days, \
+                             shares, prices, window)
     
     backtest_data = {
-                     'daily_drawdown': pd.DataFrame(daily_drawdown),
-                     'max_daily_drawdown': pd.DataFrame(max_daily_drawdown),
-                     'cummulative_return': returns.cumsum()[-1],
-                     'sharpe_ratio': sharpe_ratio,
-                     'cagr': cagr
+                     'daily_drawdown': pd.DataFrame({'daily_df': daily_drawdown}, index = df_close.index),
+                     'max_daily_drawdown': pd.DataFrame({'daily_df': max_daily_drawdown}, index = df_close.index),
+                     'cummulative_return': result.cummulative_return,
+                     'sharpe_ratio': result.sharpe_ratio,
+                     'cagr': result.cagr,
+                     'metrics': result
                      }
     return backtest_data
 
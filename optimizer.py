@@ -0,0 +1,268 @@
+import json
+import multiprocessing as mp
+from multiprocessing import shared_memory
+import os
+import re
+import threading
+import time
+import numpy as np
+import pandas as pd
+from hyperopt import tpe, Trials, STATUS_OK, STATUS_FAIL, JOB_STATE_DONE
+from hyperopt.base import Domain
+from hyperopt.pyll import Apply
+
+
+
+# State of a pool worker: the shared price frame and the fixed strategy parameters
+_worker = {}
+
+
+def share_frame(df):
+    # Copy the DatetimeIndex (as int64 ns) and the numeric columns of `df`
+    # into one shared memory block that workers can map without pickling
+    df = df.select_dtypes(include = [np.number])
+    n, k = df.shape
+    shm = shared_memory.SharedMemory(create = True, size = max(8 * n * (k + 1), 1))
+    index = np.ndarray(n, dtype = np.int64, buffer = shm.buf)
+    index[:] = df.index.asi8
+    values = np.ndarray((n, k), dtype = float, buffer = shm.buf, offset = 8 * n)
+    values[:] = df.values
+
+    meta = {'name': shm.name, 'n': n, 'columns': list(df.columns),
+            'tz': str(df.index.tz) if df.index.tz is not None else None}
+    return shm, meta
+
+
+def attach_frame(meta):
+    shm = shared_memory.SharedMemory(name = meta['name'])
+
+    n = meta['n']
+    index = pd.DatetimeIndex(np.ndarray(n, dtype = np.int64, buffer = shm.buf).view('M8[ns]'))
+    if meta['tz'] is not None:
+        index = index.tz_localize('UTC').tz_convert(meta['tz'])
+    values = np.ndarray((n, len(meta['columns'])), dtype = float, buffer = shm.buf, offset = 8 * n)
+    df = pd.DataFrame(values, index = index, columns = meta['columns'], copy = False)
+    return shm, df
+
+
+def _init_worker(meta, score, paras):
+    shm, df = attach_frame(meta)
+    _worker.update(shm = shm, score = score, paras = dict(paras, df = df))
+
+
+def _subsample(df, fraction):
+    # Most recent `fraction` of the history, used to screen trials cheaply
+    return df.iloc[-max(int(len(df) * fraction), 2):]
+
+
+def _evaluate(params, fraction = None):
+    paras = _worker['paras']
+    if fraction is not None:
+        # Keep the same slice object so cached indicators are reused across trials
+        if _worker.get('fraction') != fraction:
+            _worker.update(fraction = fraction, sub = _subsample(paras['df'], fraction))
+        paras = dict(paras, df = _worker['sub'])
+    return float(_worker['score'](dict(paras, **params)))
+
+
+def _trial_params(trial):
+    return {label: vals[0] for label, vals in trial['misc']['vals'].items() if vals}
+
+
+def _point_docs(trials, points):
+    # Trial documents for fixed parameter points, in the layout tpe.suggest produces
+    tids = trials.new_trial_ids(len(points))
+    miscs = [{'tid': tid, 'cmd': ('domain_attachment', 'FMinIter_Domain'), 'workdir': None,
+              'idxs': {k: [tid] for k in point}, 'vals': {k: [v] for k, v in point.items()}}
+             for tid, point in zip(tids, points)]
+    return trials.new_trial_docs(tids, [None] * len(points), [{'status': 'new'}] * len(points), miscs)
+
+
+def optimise(score, fspace, max_evals = 100, n_workers = 1, seed = None, trials = None,
+             patience = None, timeout = None, prune_fraction = None, n_startup = 10, points = None):
+    # Minimise `score` over the hyperopt nodes of `fspace` with TPE, the other
+    # entries of `fspace` (df, commission, interval...) are passed unchanged.
+    # With n_workers > 1 each batch of trials is scored in a process pool that
+    # maps `df` from shared memory. Results are reproducible for a fixed
+    # (seed, n_workers) pair.
+    #
+    # The search stops before max_evals when the best loss has not improved for
+    # `patience` trials or after `timeout` seconds. With `prune_fraction` set,
+    # each trial is first scored on that last fraction of the history, and once
+    # `n_startup` trials have been seen, trials scoring worse there than the
+    # median are dropped without a full evaluation (TPE ignores them, and they
+    # do not count towards `patience`).
+    #
+    # `points` (a list of parameter dicts, e.g. the best ones of an earlier run)
+    # are scored first, so TPE continues from there instead of from scratch.
+    #
+    # Returns (best params, info) where info holds stop_reason ('max_evals',
+    # 'no_improvement' or 'timeout'), n_trials, n_pruned and elapsed seconds.
+    space = {k: v for k, v in fspace.items() if isinstance(v, Apply)}
+    paras = {k: v for k, v in fspace.items() if k not in space}
+    domain = Domain(score, space)
+    trials = Trials() if trials is None else trials
+    rstate = np.random.RandomState(seed)
+    start = time.time()
+
+    pool = shm = None
+    if n_workers > 1:
+        shm, meta = share_frame(paras['df'])
+        worker_paras = {k: v for k, v in paras.items() if k != 'df'}
+        # Spawn rather than fork, the caller may be a multi-threaded web server
+        pool = mp.get_context('spawn').Pool(n_workers, initializer = _init_worker,
+                                            initargs = (meta, score, worker_paras))
+    sub_paras = dict(paras, df = _subsample(paras['df'], prune_fraction)) if prune_fraction else None
+
+    def evaluate(params, full):
+        if pool is not None:
+            if full:
+                return pool.map(_evaluate, params)
+            return pool.starmap(_evaluate, [(p, prune_fraction) for p in params])
+        return [float(score(dict(paras if full else sub_paras, **p))) for p in params]
+
+    best_loss = np.inf
+    since_best = 0
+    sub_losses = []
+    n_pruned = 0
+    stop_reason = 'max_evals'
+    try:
+        if points:
+            docs = _point_docs(trials, points[:max_evals])
+            losses = evaluate([_trial_params(doc) for doc in docs], full = True)
+            for doc, loss in zip(docs, losses):
+                doc['state'] = JOB_STATE_DONE
+                doc['result'] = {'loss': loss, 'status': STATUS_OK}
+                best_loss = min(best_loss, loss) if not np.isnan(loss) else best_loss
+            trials.insert_trial_docs(docs)
+            trials.refresh()
+
+        while len(trials) < max_evals:
+            # At least one batch is scored, whatever the timeout
+            if timeout is not None and len(trials) > 0 and time.time() - start > timeout:
+                stop_reason = 'timeout'
+                break
+            if patience is not None and since_best >= patience:
+                stop_reason = 'no_improvement'
+                break
+
+            # TPE suggests one point per call, pending points count as failed
+            batch = []
+            for _ in range(min(n_workers, max_evals - len(trials))):
+                new_ids = trials.new_trial_ids(1)
+                docs = tpe.suggest(new_ids, domain, trials, rstate.randint(2 ** 31 - 1))
+                trials.insert_trial_docs(docs)
+                trials.refresh()
+                batch.extend(new_ids)
+
+            pending = [t for t in trials.trials if t['tid'] in batch]
+            params = [_trial_params(t) for t in pending]
+            keep = [True] * len(pending)
+            if prune_fraction:
+                losses = evaluate(params, full = False)
+                if len(sub_losses) >= n_startup:
+                    threshold = np.nanmedian(sub_losses)
+                    keep = [not loss > threshold for loss in losses]
+                sub_losses.extend(losses)
+
+            survivors = [p for p, k in zip(params, keep) if k]
+            losses = iter(evaluate(survivors, full = True) if survivors else [])
+            for trial, k in zip(pending, keep):
+                trial['state'] = JOB_STATE_DONE
+                if not k:
+                    trial['result'] = {'status': STATUS_FAIL, 'pruned': True}
+                    n_pruned += 1
+                    continue
+                loss = next(losses)
+                trial['result'] = {'loss': loss, 'status': STATUS_OK}
+                if loss < best_loss:
+                    best_loss = loss
+                    since_best = 0
+                else:
+                    since_best += 1
+            trials.refresh()
+    finally:
+        if pool is not None:
+            pool.terminate()
+            pool.join()
+            shm.close()
+            shm.unlink()
+
+    done = [t for t in trials.trials if t['result'].get('status') == STATUS_OK]
+    losses = [t['result']['loss'] for t in done]
+    if np.all(np.isnan(losses)):
+        raise ValueError('none of the %d trials gave a loss, e.g. the series is too short for '
+                         'the parameters searched' % len(trials))
+    info = {'stop_reason': stop_reason, 'n_trials': len(trials), 'n_pruned': n_pruned,
+            'elapsed': time.time() - start}
+    return _trial_params(done[int(np.nanargmin(losses))]), info
+
+
+def history_key(strategy, ticker, interval, costs = None, commission = 0.0015):
+    # TrialHistory key of a strategy's runs on one series. Every field of the
+    # cost model moves the optimum, runs without one only differ by commission.
+    if costs is None:
+        return (strategy, ticker.upper(), interval, commission)
+    return (strategy, ticker.upper(), interval) + tuple(costs)
+
+
+def optimise_from_history(score, fspace, strategy, ticker, interval, costs = None, history = None, \
+                          patience = 30, **options):
+    # `optimise` continuing from earlier runs: with a TrialHistory and a ticker,
+    # the best points of past runs under the same key are scored first, and the
+    # new trials are added to the history afterwards
+    key = points = None
+    if history is not None and ticker:
+        key = history_key(strategy, ticker, interval, costs, fspace['commission'])
+        points = history.best(key)
+    if points and patience is not None:
+        # Past optima are re-scored first, a shorter search finds whether they moved
+        patience = min(patience, 10)
+    trials = Trials()
+    best, info = optimise(score, fspace, patience = patience, trials = trials, points = points, **options)
+    if key is not None:
+        history.update(key, trials)
+    return best, info
+
+
+class TrialHistory(object):
+    # Past TPE evaluations stored as one JSON file per key, e.g. (strategy,
+    # ticker, interval, cost model fields), under `root`, so that a rerun on the same series
+    # (typically with a few more bars) can start from the best known points.
+    def __init__(self, root, max_points = 200):
+        self.root = root
+        self.max_points = max_points
+        self._lock = threading.Lock()
+
+    def best(self, key, n = 10):
+        # Parameters of the `n` lowest losses recorded for `key`
+        return [point['params'] for point in self._load(key)[:n]]
+
+    def update(self, key, trials):
+        # Merge the finished trials into the history, newer losses replace older ones
+        with self._lock:
+            points = {json.dumps(p['params'], sort_keys = True): p for p in self._load(key)}
+            for trial in trials.trials:
+                result = trial['result']
+                if result.get('status') == STATUS_OK and not np.isnan(result['loss']):
+                    params = {k: float(v) for k, v in _trial_params(trial).items()}
+                    points[json.dumps(params, sort_keys = True)] = {'params': params, 'loss': float(result['loss'])}
+            points = sorted(points.values(), key = lambda p: p['loss'])[:self.max_points]
+
+            path = self._path(key)
+            os.makedirs(self.root, exist_ok = True)
+            tmp = path + '.tmp'
+            with open(tmp, 'w') as f:
+                json.dump(points, f)
+            os.replace(tmp, path)
+
+    def _load(self, key):
+        path = self._path(key)
+        if not os.path.exists(path):
+            return []
+        with open(path) as f:
+            return json.load(f)
+
+    def _path(self, key):
+        name = '_'.join(str(part) for part in key)
+        return os.path.join(self.root, re.sub(r'[^A-Za-z0-9.\-]+', '_', name) + '.json')
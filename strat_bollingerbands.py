@@ -1,10 +1,13 @@
 import pandas as pd
-from hyperopt import hp, tpe, fmin
+import numpy as np
+from hyperopt import hp
 import matplotlib.pyplot as plt
 from matplotlib import style
 style.use('ggplot')
 
 import lib
+import optimizer
+import walkforward
 
 
 
@@ -15,28 +18,136 @@ def find_signals(paras):
 
     # Initialize the `signals` DataFrame with the `signal` column
     signals = pd.DataFrame(index=df.index)
-    signals['signal'] = None
 
-    rolling_mean = df['Open'].rolling(window).mean()
-    rolling_std = df['Open'].rolling(window).std()
+    rolling_mean = lib.rolling_mean(df, 'Open', window)
+    rolling_std = lib.rolling_std(df, 'Open', window)
     
     signals['bollinger_high'] = rolling_mean + (rolling_std * no_of_std)
     signals['bollinger_low'] = rolling_mean - (rolling_std * no_of_std)
     
-    for row in range(len(df)):
-        if (df['Open'].iloc[row] > signals['bollinger_high'].iloc[row]) and (df['Open'].iloc[row-1] < signals['bollinger_high'].iloc[row-1]):
-            signals['signal'].iloc[row] = 0.0
-        
-        if (df['Open'].iloc[row] < signals['bollinger_low'].iloc[row]) and (df['Open'].iloc[row-1] > signals['bollinger_low'].iloc[row-1]):
-            signals['signal'].iloc[row] = 1
-            
-    signals['signal'].fillna(method='ffill',inplace=True)
+    # Detect band crossings by comparing each bar with the previous one
+    price = df['Open']
+    prev_price = price.shift(1)
+    cross_high = (price > signals['bollinger_high']) & (prev_price < signals['bollinger_high'].shift(1))
+    cross_low = (price < signals['bollinger_low']) & (prev_price > signals['bollinger_low'].shift(1))
+    
+    # Sell on crossing above the upper band, buy on crossing below the lower band,
+    # then hold the last state until the next crossing
+    signal = np.where(cross_low, 1.0, np.where(cross_high, 0.0, np.nan))
+    signals.insert(0, 'signal', signal)
+    signals['signal'].fillna(method='ffill', inplace=True)
     
     # Generate trading orders
     signals['signal'].fillna(0.0, inplace=True)    
     signals['position'] = signals['signal'].diff()
     
     return signals
+
+
+def signal_matrix(prices, paras):
+    # `find_signals` for a (time x symbol) frame of Open prices, every symbol
+    # at once. Returns the `signal` column of each symbol as a 2-D array.
+    window = int(paras['window'])
+    no_of_std = paras['std']
+    rolling = prices.rolling(window)
+    rolling_mean = rolling.mean().values
+    rolling_std = rolling.std().values
+    high = rolling_mean + rolling_std * no_of_std
+    low = rolling_mean - rolling_std * no_of_std
+    
+    price = prices.values
+    with np.errstate(invalid='ignore'):
+        cross_high = (price[1:] > high[1:]) & (price[:-1] < high[:-1])
+        cross_low = (price[1:] < low[1:]) & (price[:-1] > low[:-1])
+    signal = np.full(price.shape, np.nan)
+    signal[1:][cross_high] = 0.0
+    signal[1:][cross_low] = 1.0
+    return pd.DataFrame(signal).fillna(method='ffill').fillna(0.0).values
+    
+    
+class _RunningVariance(object):
+    # Welford mean and variance of the last `window` values kept in a ring buffer,
+    # defined only while the window holds `window` non-NaN values (like rolling())
+    def __init__(self, window):
+        self.window = int(window)
+        self._values = np.full(self.window, np.nan)
+        self._head = 0
+        self._count = 0
+        self._mean = 0.0
+        self._m2 = 0.0
+        
+    def update(self, value):
+        old = self._values[self._head]
+        if not np.isnan(old):
+            self._count -= 1
+            if self._count == 0:
+                self._mean, self._m2 = 0.0, 0.0
+            else:
+                delta = old - self._mean
+                self._mean -= delta / self._count
+                self._m2 -= delta * (old - self._mean)
+        if not np.isnan(value):
+            self._count += 1
+            delta = value - self._mean
+            self._mean += delta / self._count
+            self._m2 += delta * (value - self._mean)
+        self._values[self._head] = value
+        self._head = (self._head + 1) % self.window
+        # Recompute from the buffer once per lap so round-off doesn't accumulate
+        if self._head == 0 and self._count:
+            valid = self._values[~np.isnan(self._values)]
+            self._mean = valid.mean()
+            self._m2 = ((valid - self._mean) ** 2).sum()
+            
+        if self._count < self.window or self.window < 2:
+            return np.nan, np.nan
+        return self._mean, np.sqrt(max(self._m2, 0.0) / (self.window - 1))
+
+
+class BollingerBandsStream(object):
+    # Incremental `find_signals`: bars are consumed one at a time (or in blocks
+    # with update_frame) with O(1) band updates, giving the batch bands to
+    # floating-point tolerance and the same crossing signals
+    def __init__(self, window, no_of_std):
+        self.window = int(window)
+        self.no_of_std = no_of_std
+        self._stats = _RunningVariance(self.window)
+        self.n_bars = 0
+        self.signal = 0.0
+        self.price = np.nan
+        self.bollinger_high = np.nan
+        self.bollinger_low = np.nan
+        
+    def update(self, price):
+        # Consume one open price, return the position change: 1.0 buy, -1.0 sell,
+        # 0.0 hold (NaN for the very first bar, like `diff()`)
+        price = float(price)
+        mean, std = self._stats.update(price)
+        high = mean + std * self.no_of_std
+        low = mean - std * self.no_of_std
+        
+        signal = self.signal
+        if price > high and self.price < self.bollinger_high:
+            signal = 0.0
+        if price < low and self.price > self.bollinger_low:
+            signal = 1.0
+        position = signal - self.signal if self.n_bars > 0 else np.nan
+        
+        self.signal = signal
+        self.price = price
+        self.bollinger_high = high
+        self.bollinger_low = low
+        self.n_bars += 1
+        return position
+    
+    def update_frame(self, df):
+        # Consume a block of bars and return their rows of the `find_signals` frame
+        rows = []
+        for price in df['Open'].values:
+            position = self.update(price)
+            rows.append((self.signal, self.bollinger_high, self.bollinger_low, position))
+        return pd.DataFrame(rows, index = df.index,
+                            columns = ['signal', 'bollinger_high', 'bollinger_low', 'position'])
     
     
 def plot_signals(signals, paras):
@@ -66,21 +177,29 @@ def score(paras):
     commission = paras['commission']
     interval = paras['interval']
     signals = find_signals(paras)
-    portfolio, port_intraday = lib.compute_portfolio(df, signals, commission, interval)
-    returns = portfolio['returns']
+    returns = lib.portfolio_returns(df, signals['signal'].values, commission, interval, paras.get('costs'))
     # annualized Sharpe ratio
     sharpe_ratio = lib.annualised_sharpe(returns)
     return -sharpe_ratio
 
 
-def run_strat(df, interval = 'daily'):
-    commission = 0.0015
+# Hyperparameter search space of `run_strat`
+SPACE = {'window': hp.quniform('window', 10, 100, 5), 'std': hp.quniform('std', 1, 3, 0.2)}
+
+
+def run_strat(df, interval = 'daily', n_workers = 1, seed = None, \
+              patience = 30, timeout = None, prune_fraction = None, ticker = None, history = None, costs = None):
+    # `costs` is an optional lib.CostModel, fees and slippage then come out of the cash
+    commission = 0.0015 if costs is None else costs.commission
         
     #Tuning hyperparameter
-    fspace = {'df': df, 'commission': commission, 'interval': interval, \
-              'window':hp.quniform('window', 10, 100, 5), 'std':hp.quniform('std', 1, 3, 0.2)}
+    fspace = dict(SPACE, df = df, commission = commission, interval = interval, costs = costs)
     
-    best = fmin(fn = score, space = fspace, algo = tpe.suggest, max_evals = 100)
+    # Reruns on the same ticker start from the best points of earlier runs, and the
+    # search stops early once no better parameters turned up in `patience` trials
+    best, search = optimizer.optimise_from_history(score, fspace, 'bollingerbands', ticker, interval, costs, \
+                                                   history, patience = patience, max_evals = 100, n_workers = n_workers, \
+                                                   seed = seed, timeout = timeout, prune_fraction = prune_fraction)
     print(best)
     
     #Run strategy with new parameters
@@ -88,25 +207,38 @@ def run_strat(df, interval = 'daily'):
                   'window': best['window'], 'std': best['std']} 
     signals = find_signals(paras_best)
     
-    portfolio, port_intraday = lib.compute_portfolio(df, signals, commission, interval)
-    backtest_data = lib.backtesting(portfolio)
+    portfolio, port_intraday = lib.compute_portfolio(df, signals, commission, interval, costs)
+    shares = port_intraday['daily_df'].values / df['Close'].values
+    backtest_data = lib.backtesting(portfolio, shares = shares, prices = df['Close'].values)
     backtest_data['optimal_paras'] = {'window': best['window'], \
                                       'std': best['std']} 
 
     report_dict = {
-            'df': df.to_json(orient = 'split', date_format = 'iso'),
+            'df': df,
             'commission': commission,
-            'daily_drawdown': backtest_data['daily_drawdown'].to_json(orient = 'split', date_format = 'iso'),
-            'max_daily_drawdown': backtest_data['max_daily_drawdown'].to_json(orient = 'split', date_format = 'iso'),
+            'daily_drawdown': backtest_data['daily_drawdown'],
+            'max_daily_drawdown': backtest_data['max_daily_drawdown'],
             'cummulative_return': backtest_data['cummulative_return'],
             'sharpe_ratio': backtest_data['sharpe_ratio'],
             'cagr': backtest_data['cagr'],
+            'metrics': dict(backtest_data['metrics']._asdict()),
             'strategy': 'bollingerbands',
             'optimal_paras': backtest_data['optimal_paras'],
-            'signals': signals.to_json(orient = 'split', date_format = 'iso'),
-            'portfolio': portfolio.to_json(orient = 'split', date_format = 'iso'),
-            'port_intraday': port_intraday.to_json(orient = 'split', date_format = 'iso'),
+            'stop_reason': search['stop_reason'],
+            'n_trials': search['n_trials'],
+            'signals': signals,
+            'portfolio': portfolio,
+            'port_intraday': port_intraday,
             }
         
     return report_dict
 
+
+def run_walk_forward(df, interval = 'daily', n_folds = 5, anchored = False, n_workers = 1, seed = None, **kwargs):
+    # Out-of-sample counterpart of `run_strat`: parameters are re-optimised on
+    # each training window and only traded on the window after it
+    report_dict = walkforward.walk_forward(find_signals, SPACE, df, interval, commission = 0.0015, \
+                                           n_folds = n_folds, anchored = anchored, n_workers = n_workers, \
+                                           seed = seed, **kwargs)
+    report_dict['strategy'] = 'bollingerbands'
+    return report_dict
@@ -1,11 +1,13 @@
 import pandas as pd
 import numpy as np
-from hyperopt import hp, tpe, fmin
+from hyperopt import hp
 import matplotlib.pyplot as plt
 from matplotlib import style
 style.use('ggplot')
 
 import lib
+import optimizer
+import walkforward
 
 
 
@@ -19,8 +21,8 @@ def find_signals(paras):
     signals['signal'] = 0.0
     
     # Create short and long MA
-    signals['short_mavg'] = df['Open'].rolling(window=short_window, min_periods=1, center=False).mean()
-    signals['long_mavg'] = df['Open'].rolling(window=long_window, min_periods=1, center=False).mean()
+    signals['short_mavg'] = lib.rolling_mean(df, 'Open', short_window, min_periods=1)
+    signals['long_mavg'] = lib.rolling_mean(df, 'Open', long_window, min_periods=1)
     
     # Create signals
     signals['signal'][short_window:] = np.where(signals['short_mavg'][short_window:] 
@@ -30,6 +32,81 @@ def find_signals(paras):
     signals['position'] = signals['signal'].diff()
     
     return signals
+
+
+def signal_matrix(prices, paras):
+    # `find_signals` for a (time x symbol) frame of Open prices, every symbol
+    # at once. Returns the `signal` column of each symbol as a 2-D array.
+    short_window = int(paras['short_window'])
+    long_window = int(paras['long_window'])
+    short_mavg = prices.rolling(short_window, min_periods=1).mean().values
+    long_mavg = prices.rolling(long_window, min_periods=1).mean().values
+    
+    signal = np.where(short_mavg > long_mavg, 1.0, 0.0)
+    signal[:short_window] = 0.0
+    return signal
+    
+    
+class _RunningMean(object):
+    # Mean of the last `window` values (min_periods=1, NaN skipped) kept in a ring buffer
+    def __init__(self, window):
+        self.window = int(window)
+        self._values = np.full(self.window, np.nan)
+        self._head = 0
+        self._sum = 0.0
+        self._count = 0
+        
+    def update(self, value):
+        old = self._values[self._head]
+        if not np.isnan(old):
+            self._sum -= old
+            self._count -= 1
+        if not np.isnan(value):
+            self._sum += value
+            self._count += 1
+        self._values[self._head] = value
+        self._head = (self._head + 1) % self.window
+        # Re-sum once per lap so round-off doesn't accumulate, O(1) amortised
+        if self._head == 0:
+            self._sum = np.nansum(self._values)
+        return self._sum / self._count if self._count else np.nan
+
+
+class MACrossoverStream(object):
+    # Incremental `find_signals` for live bars: each new open price updates the
+    # short and long means in O(1) and yields the same signal/position values
+    # the batch function gives for that bar
+    def __init__(self, short_window, long_window):
+        self.short_window = int(short_window)
+        self.long_window = int(long_window)
+        self._short = _RunningMean(self.short_window)
+        self._long = _RunningMean(self.long_window)
+        self.n_bars = 0
+        self.signal = 0.0
+        self.short_mavg = np.nan
+        self.long_mavg = np.nan
+        
+    def update(self, price):
+        # Consume one open price, return the position change: 1.0 buy, -1.0 sell,
+        # 0.0 hold (NaN for the very first bar, like `diff()`)
+        self.short_mavg = self._short.update(float(price))
+        self.long_mavg = self._long.update(float(price))
+        signal = 0.0
+        if self.n_bars >= self.short_window and self.short_mavg > self.long_mavg:
+            signal = 1.0
+        position = signal - self.signal if self.n_bars > 0 else np.nan
+        self.signal = signal
+        self.n_bars += 1
+        return position
+    
+    def update_frame(self, df):
+        # Consume a block of bars and return their rows of the `find_signals` frame
+        rows = []
+        for price in df['Open'].values:
+            position = self.update(price)
+            rows.append((self.signal, self.short_mavg, self.long_mavg, position))
+        return pd.DataFrame(rows, index = df.index, 
+                            columns = ['signal', 'short_mavg', 'long_mavg', 'position'])
     
     
 def plot_signals(signals, paras):
@@ -61,22 +138,87 @@ def score(paras):
     commission = paras['commission']
     interval = paras['interval']
     signals = find_signals(paras)
-    portfolio, port_intraday = lib.compute_portfolio(df, signals, commission, interval)
-    returns = portfolio['returns']
+    returns = lib.portfolio_returns(df, signals['signal'].values, commission, interval, paras.get('costs'))
     # annualized Sharpe ratio
     sharpe_ratio = lib.annualised_sharpe(returns)
     return -sharpe_ratio
 
 
-def run_strat(df, interval = 'daily'):
-    commission = 0.0015
+# Window grids matching the hyperopt search space in `run_strat`
+SHORT_WINDOWS = np.arange(5, 26)
+LONG_WINDOWS = np.arange(50, 201, 10)
+
+
+def rolling_means(values, windows):
+    # Rolling means (min_periods=1) for every window from one cumulative sum,
+    # NaN values are skipped like `Series.rolling().mean()` does
+    values = np.asarray(values, dtype=float)
+    valid = ~np.isnan(values)
+    # Shift by the first valid value to limit the round-off of the cumulative sum
+    offset = values[valid][0] if valid.any() else 0.0
+    csum = np.concatenate(([0.0], np.cumsum(np.where(valid, values - offset, 0.0))))
+    ccount = np.concatenate(([0], np.cumsum(valid)))
+    
+    end = np.arange(1, len(values) + 1)
+    means = np.empty((len(windows), len(values)))
+    for i, window in enumerate(windows):
+        start = np.maximum(end - int(window), 0)
+        count = ccount[end] - ccount[start]
+        with np.errstate(invalid='ignore', divide='ignore'):
+            means[i] = (csum[end] - csum[start]) / count + offset
+        means[i][count == 0] = np.nan
+    return means
+
+
+def find_sharpe_grid(df, short_windows = SHORT_WINDOWS, long_windows = LONG_WINDOWS, interval = 'daily', \
+                     costs = None):
+    # Evaluate every (short_window, long_window) pair in one pass and return
+    # the Sharpe ratios as a (len(short_windows), len(long_windows)) matrix.
+    # Returns are frictionless unless `costs` (a lib.CostModel) is given.
+    short_windows = np.asarray(short_windows, dtype=int)
+    long_windows = np.asarray(long_windows, dtype=int)
+    short_mavg = rolling_means(df['Open'].values, short_windows)
+    long_mavg = rolling_means(df['Open'].values, long_windows)
+    # Bars before `short_window` carry no signal, as in `find_signals`
+    warmup = np.arange(len(df)) < short_windows[:, None]
+    
+    sharpe = np.empty((len(short_windows), len(long_windows)))
+    for j in range(len(long_windows)):
+        signal = np.where(warmup, 0.0, (short_mavg > long_mavg[j]).astype(float))
+        if costs is None:
+            sharpe[:, j] = lib.annualised_sharpe(lib.portfolio_returns(df, signal, 0.0, interval))
+        else:
+            # The execution kernel works on one series at a time
+            sharpe[:, j] = [lib.annualised_sharpe(lib.portfolio_returns(df, row, costs.commission, interval, costs))
+                            for row in signal]
+    return sharpe
+
+
+# Hyperparameter search space of `run_strat`
+SPACE = {'short_window': hp.quniform('short_window', 5, 25, 1), \
+         'long_window': hp.quniform('long_window', 50, 200, 10)}
+
+
+def run_strat(df, interval = 'daily', method = 'tpe', n_workers = 1, seed = None, \
+              patience = 30, timeout = None, prune_fraction = None, ticker = None, history = None, costs = None):
+    # `costs` is an optional lib.CostModel, fees and slippage then come out of the cash
+    commission = 0.0015 if costs is None else costs.commission
         
     #Tuning hyperparameter
-    fspace = {'df': df, 'commission': commission, 'interval': interval, \
-              'short_window':hp.quniform('short_window', 5, 25, 1), \
-              'long_window':hp.quniform('long_window', 50, 200, 10)}
+    fspace = dict(SPACE, df = df, commission = commission, interval = interval, costs = costs)
     
-    best = fmin(fn = score, space = fspace, algo = tpe.suggest, max_evals = 100)
+    if method == 'grid':
+        # Exhaustive search over the same grid with the batch engine
+        sharpe = find_sharpe_grid(df, interval = interval, costs = costs)
+        i, j = np.unravel_index(np.nanargmax(sharpe), sharpe.shape)
+        best = {'short_window': float(SHORT_WINDOWS[i]), 'long_window': float(LONG_WINDOWS[j])}
+        search = {'stop_reason': 'grid', 'n_trials': sharpe.size, 'n_pruned': 0}
+    else:
+        # Reruns on the same ticker start from the best points of earlier runs, and the
+        # search stops early once no better parameters turned up in `patience` trials
+        best, search = optimizer.optimise_from_history(score, fspace, 'macrossover', ticker, interval, costs, \
+                                                       history, patience = patience, max_evals = 100, n_workers = n_workers, \
+                                                       seed = seed, timeout = timeout, prune_fraction = prune_fraction)
     print(best)
     
     #Run strategy with new parameters
@@ -84,25 +226,38 @@ def run_strat(df, interval = 'daily'):
                   'short_window': best['short_window'], 'long_window': best['long_window']} 
     signals = find_signals(paras_best)
     
-    portfolio, port_intraday = lib.compute_portfolio(df, signals, commission, interval)
-    backtest_data = lib.backtesting(portfolio)
+    portfolio, port_intraday = lib.compute_portfolio(df, signals, commission, interval, costs)
+    shares = port_intraday['daily_df'].values / df['Close'].values
+    backtest_data = lib.backtesting(portfolio, shares = shares, prices = df['Close'].values)
     backtest_data['optimal_paras'] = {'short_window': best['short_window'], \
                                       'long_window': best['long_window']} 
 
     report_dict = {
-            'df': df.to_json(orient = 'split', date_format = 'iso'),
+            'df': df,
             'commission': commission,
-            'daily_drawdown': backtest_data['daily_drawdown'].to_json(orient = 'split', date_format = 'iso'),
-            'max_daily_drawdown': backtest_data['max_daily_drawdown'].to_json(orient = 'split', date_format = 'iso'),
+            'daily_drawdown': backtest_data['daily_drawdown'],
+            'max_daily_drawdown': backtest_data['max_daily_drawdown'],
             'cummulative_return': backtest_data['cummulative_return'],
             'sharpe_ratio': backtest_data['sharpe_ratio'],
             'cagr': backtest_data['cagr'],
+            'metrics': dict(backtest_data['metrics']._asdict()),
             'strategy': 'macrossover',
             'optimal_paras': backtest_data['optimal_paras'],
-            'signals': signals.to_json(orient = 'split', date_format = 'iso'),
-            'portfolio': portfolio.to_json(orient = 'split', date_format = 'iso'),
-            'port_intraday': port_intraday.to_json(orient = 'split', date_format = 'iso'),
+            'stop_reason': search['stop_reason'],
+            'n_trials': search['n_trials'],
+            'signals': signals,
+            'portfolio': portfolio,
+            'port_intraday': port_intraday,
             }
         
     return report_dict
 
+
+def run_walk_forward(df, interval = 'daily', n_folds = 5, anchored = False, n_workers = 1, seed = None, **kwargs):
+    # Out-of-sample counterpart of `run_strat`: parameters are re-optimised on
+    # each training window and only traded on the window after it
+    report_dict = walkforward.walk_forward(find_signals, SPACE, df, interval, commission = 0.0015, \
+                                           n_folds = n_folds, anchored = anchored, n_workers = n_workers, \
+                                           seed = seed, **kwargs)
+    report_dict['strategy'] = 'macrossover'
+    return report_dict
@@ -0,0 +1,7 @@
+# Tests of the top-level engine modules (lib, optimizer, ...), which import each
+# other by module name: run them with the repository root on the path
+
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
@@ -0,0 +1,16 @@
+# Tests for the portfolio kernels
+
+import numpy as np
+
+import lib
+
+
+def test_trade_before_first_quote_is_deferred():
+    # The signal is on from the first bar, but there is no price to fill at
+    # until the second: the buy happens there and the cash stays finite
+    close = [np.nan, 10.0, 11.0, 12.0, 13.0]
+    signal = [1, 1, 0, 1, 1]
+    result = lib.execution_kernel(close, close, signal, lib.CostModel(commission = 0.0))
+    assert not np.isnan(result['cash']).any()
+    np.testing.assert_allclose(result['position'], [0, 100, 0, 100, 100])
+    np.testing.assert_allclose(result['total'], [100000, 100000, 100100, 100100, 100200])
@@ -0,0 +1,25 @@
+# Tests for the TPE search loop
+
+import numpy as np
+import pandas as pd
+import pytest
+from hyperopt import hp
+
+import optimizer
+
+
+def space():
+    return {'x': hp.uniform('x', 0, 10), 'df': pd.DataFrame({'Close': np.arange(10.0)})}
+
+
+def test_timeout_scores_one_batch():
+    best, info = optimizer.optimise(lambda p: (p['x'] - 3) ** 2, space(), max_evals = 50, timeout = 0)
+
+    assert info['stop_reason'] == 'timeout'
+    assert info['n_trials'] == 1
+    assert 0 <= best['x'] <= 10
+
+
+def test_no_loss_raises():
+    with pytest.raises(ValueError):
+        optimizer.optimise(lambda p: np.nan, space(), max_evals = 5)
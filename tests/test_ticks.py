@@ -0,0 +1,44 @@
+# Tests for the tick-file ingest of the top-level lib module
+
+import numpy as np
+import pandas as pd
+
+import lib
+
+
+def write_ticks(path, n=5000):
+    # Two days of ticks with many repeated timestamps, as real feeds have
+    rs = np.random.RandomState(0)
+    seconds = np.sort(rs.randint(9 * 3600, 12 * 3600, n))
+    days = np.sort(rs.choice(['02-Jan-18', '03-Jan-18'], n), kind='mergesort')
+    pd.DataFrame({
+        'TRADINGDATE': days,
+        'TRADINGTIME': ['%02d:%02d:%02d' % (s // 3600, s // 60 % 60, s % 60) for s in seconds],
+        'OPENPRICE': rs.rand(n).round(3), 'LASTPRICE': rs.rand(n).round(3),
+        'HIGHPRICE': rs.rand(n).round(3), 'LOWPRICE': rs.rand(n).round(3),
+        'TOTALQTTY': rs.randint(1, 100, n)
+    }).to_csv(path, index=False)
+
+
+def test_chunked_matches_preprocessing_with_repeated_timestamps(tmpdir):
+    path = str(tmpdir.join('ticks.csv'))
+    write_ticks(path)
+    expected = lib.preprocessing(pd.read_csv(path))
+    result = lib.preprocessing_chunked(path, chunksize=700, workdir=str(tmpdir))
+
+    assert len(result) == len(expected)
+    for column in ['Open', 'High', 'Low', 'Close', 'Volume']:
+        np.testing.assert_array_equal(result[column].values, expected[column].values)
+
+
+def test_parse_tick_timestamps_missing_values():
+    dates = pd.Series(['02-Jan-18', np.nan, '03-Jan-18'])
+    times = pd.Series(['09:00:01', '10:00:00', np.nan])
+    stamps = lib.parse_tick_timestamps(dates, times).view('M8[ns]')
+    assert stamps[0] == np.datetime64('2018-01-02T09:00:01')
+    assert np.isnat(stamps[1:]).all()
+
+    # A chunk whose time or date column is entirely empty
+    all_nan = pd.Series([np.nan, np.nan])
+    assert np.isnat(lib.parse_tick_timestamps(dates[:2], all_nan).view('M8[ns]')).all()
+    assert np.isnat(lib.parse_tick_timestamps(all_nan, times[:2]).view('M8[ns]')).all()
@@ -0,0 +1,58 @@
+import numpy as np
+import pandas as pd
+
+import lib
+
+
+
+def price_matrix(frames, column):
+    # (time x symbol) frame of `column` from a {symbol: df} dict, on the union of
+    # the symbols' timestamps. Bars a symbol has no data for are NaN.
+    return pd.DataFrame({symbol: df[column] for symbol, df in frames.items()}).sort_index()
+
+
+def backtest(open_prices, close_prices, signal_matrix, paras, commission = 0.0015, \
+             interval = 'daily', initial_capital = 100000.0):
+    # Run one strategy over a universe of symbols. `open_prices` and `close_prices`
+    # are (time x symbol) frames, e.g. from `price_matrix`, and `signal_matrix` is
+    # the strategy's function of the same name. Every symbol is its own book of
+    # `initial_capital` trading 100 shares, exactly like `compute_portfolio`,
+    # and the books are summed into one portfolio.
+    signal = signal_matrix(open_prices, paras)
+    # Value positions at the last known close while a symbol has no quote
+    close = close_prices.fillna(method = 'ffill').values
+
+    # The kernel works along the last axis, so symbols become rows
+    kernel = lib.portfolio_kernel(close.T, signal.T, commission, initial_capital)
+
+    portfolio = pd.DataFrame({
+            'holdings': kernel['holdings'].sum(axis = 0),
+            'cost': np.nansum(kernel['cost'], axis = 0),
+            'cash': kernel['cash'].sum(axis = 0),
+            'total': kernel['total'].sum(axis = 0),
+            'n_positions': (signal > 0).sum(axis = 1)
+        }, index = close_prices.index)
+    portfolio['returns'] = portfolio['total'].pct_change()
+
+    # Intraday returns are summed per day like in `compute_portfolio`, on the
+    # combined portfolio's calendar so every symbol is grouped the same way
+    calendar = pd.DataFrame({'Close': portfolio['total'].values}, index = close_prices.index)
+    symbol_returns = lib.daily_returns(calendar, kernel['returns'], interval)
+    returns = lib.daily_returns(calendar, portfolio['returns'].values, interval)
+
+    symbols = pd.DataFrame({
+            'total': kernel['total'][:, -1],
+            'cummulative_return': kernel['total'][:, -1] / kernel['total'][:, 0] - 1,
+            'sharpe_ratio': lib.annualised_sharpe(symbol_returns),
+            'trades': np.abs(np.diff(signal, axis = 0)).sum(axis = 0)
+        }, index = close_prices.columns)
+
+    report_dict = {
+            'commission': commission,
+            'optimal_paras': dict((k, v) for k, v in paras.items() if k != 'df'),
+            'portfolio': portfolio,
+            'symbols': symbols,
+            'cummulative_return': portfolio['total'].values[-1] / portfolio['total'].values[0] - 1,
+            'sharpe_ratio': lib.annualised_sharpe(returns),
+            }
+    return report_dict
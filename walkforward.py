@@ -0,0 +1,129 @@
+import multiprocessing as mp
+import numpy as np
+import pandas as pd
+
+import lib
+import optimizer
+
+
+
+# State of a pool worker: the shared price frame
+_worker = {}
+
+
+def fold_bounds(n, n_folds = 5, train_bars = None, test_bars = None, anchored = False):
+    # (train_start, train_stop, test_start, test_stop) row positions of each fold.
+    # By default the series is cut into n_folds + 1 equal blocks: the first one
+    # is only trained on and each fold tests on the block after its training window.
+    # Rolling folds train on the last `train_bars` bars, anchored ones on everything before.
+    if test_bars is None:
+        test_bars = (n - (train_bars or 0)) // (n_folds + (train_bars is None))
+    if train_bars is None:
+        train_bars = n - n_folds * test_bars
+    if test_bars < 2 or train_bars < 2 or train_bars + n_folds * test_bars > n:
+        raise ValueError('%d bars are not enough for %d folds of %s train / %s test bars' \
+                         % (n, n_folds, train_bars, test_bars))
+
+    folds = []
+    for k in range(n_folds):
+        test_start = train_bars + k * test_bars
+        train_start = 0 if anchored else test_start - train_bars
+        folds.append((train_start, test_start, test_start, test_start + test_bars))
+    return folds
+
+
+def fold_score(paras):
+    # -Sharpe over rows [start, stop) of paras['df']. The signals are computed on
+    # the whole series and sliced, so indicators are shared by all folds (through
+    # lib.rolling_cache) and the first bars of a fold get their full look-back.
+    df = paras['df']
+    signal = paras['find_signals'](paras)['signal'].values
+    rows = slice(paras['start'], paras['stop'])
+    returns = lib.portfolio_returns(df.iloc[rows], signal[rows], paras['commission'], paras['interval'])
+    return -lib.annualised_sharpe(returns)
+
+
+def _optimise_fold(df, fold, paras, space, options):
+    fspace = dict(space, df = df, start = fold[0], stop = fold[1], **paras)
+    best, search = optimizer.optimise(fold_score, fspace, **options)
+    return best, -fold_score(dict(fspace, **best)), search['stop_reason']
+
+
+def _init_worker(meta):
+    shm, df = optimizer.attach_frame(meta)
+    _worker.update(shm = shm, df = df)
+
+
+def _fold_worker(task):
+    return _optimise_fold(_worker['df'], *task)
+
+
+def walk_forward(find_signals, space, df, interval = 'daily', commission = 0.0015, n_folds = 5, \
+                 train_bars = None, test_bars = None, anchored = False, n_workers = 1, seed = None, \
+                 max_evals = 100, patience = 30):
+    # Walk-forward analysis of a strategy: TPE picks the parameters in `space`
+    # on each training window, they are then traded on the following test window.
+    # Folds are optimised in parallel with n_workers > 1. The test windows are
+    # stitched into one out-of-sample portfolio, traded continuously.
+    folds = fold_bounds(len(df), n_folds, train_bars, test_bars, anchored)
+    paras = {'find_signals': find_signals, 'commission': commission, 'interval': interval}
+    tasks = [((train_start, train_stop), paras, space,
+              {'max_evals': max_evals, 'patience': patience, 'seed': None if seed is None else seed + k})
+             for k, (train_start, train_stop, _, _) in enumerate(folds)]
+
+    if n_workers > 1:
+        shm, meta = optimizer.share_frame(df)
+        # Spawn rather than fork, the caller may be a multi-threaded web server
+        pool = mp.get_context('spawn').Pool(min(n_workers, n_folds), initializer = _init_worker,
+                                            initargs = (meta,))
+        try:
+            results = pool.map(_fold_worker, tasks)
+        finally:
+            pool.terminate()
+            pool.join()
+            shm.close()
+            shm.unlink()
+    else:
+        results = [_optimise_fold(df, *task) for task in tasks]
+
+    # Out-of-sample signal over all test windows, with a flat bar in front so
+    # that the first position is bought like any other
+    oos_start, oos_stop = folds[0][2], folds[-1][3]
+    signal = np.zeros(oos_stop - oos_start + 1)
+    fold_no = np.zeros(oos_stop - oos_start, dtype = int)
+    for k, ((_, _, test_start, test_stop), (best, _, _)) in enumerate(zip(folds, results)):
+        fold_signal = find_signals(dict(paras, df = df, **best))['signal'].values
+        signal[test_start - oos_start + 1:test_stop - oos_start + 1] = fold_signal[test_start:test_stop]
+        fold_no[test_start - oos_start:test_stop - oos_start] = k
+    kernel = lib.portfolio_kernel(df['Close'].values[oos_start - 1:oos_stop], signal, commission)
+
+    equity = pd.DataFrame({'signal': signal[1:], 'fold': fold_no}, index = df.index[oos_start:oos_stop])
+    for column in ('position', 'holdings', 'cash', 'total', 'returns'):
+        equity[column] = kernel[column][1:]
+    oos_df = df.iloc[oos_start:oos_stop]
+
+    rows = []
+    for k, ((train_start, train_stop, test_start, test_stop), (best, is_sharpe, stop_reason)) \
+            in enumerate(zip(folds, results)):
+        part = oos_df.iloc[test_start - oos_start:test_stop - oos_start]
+        returns = equity['returns'].values[test_start - oos_start:test_stop - oos_start]
+        row = {'fold': k,
+               'train_start': df.index[train_start], 'train_end': df.index[train_stop - 1],
+               'test_start': df.index[test_start], 'test_end': df.index[test_stop - 1],
+               'is_sharpe': is_sharpe,
+               'oos_sharpe': lib.annualised_sharpe(lib.daily_returns(part, returns, interval)),
+               'stop_reason': stop_reason}
+        row.update(best)
+        rows.append(row)
+    folds_df = pd.DataFrame(rows).set_index('fold')
+
+    report_dict = {
+            'df': df,
+            'commission': commission,
+            'anchored': anchored,
+            'folds': folds_df,
+            'equity': equity,
+            'cummulative_return': equity['total'].values[-1] / equity['total'].values[0] - 1,
+            'sharpe_ratio': lib.annualised_sharpe(lib.daily_returns(oos_df, equity['returns'].values, interval)),
+            }
+    return report_dict